@@ -6,12 +6,15 @@ from twisted.internet.defer import DeferredList
 
 from viff.field import GF
 from viff.runtime import make_runtime_class, create_runtime, gather_shares, Runtime
+from viff.passive import PassiveRuntime
 from viff.comparison import ComparisonToft07Mixin
 from viff.equality import ProbabilisticEqualityMixin
 from viff.config import load_config
 from viff.util import find_prime
 
 from extensions import Rel, divide
+from preprocessing import PreprocessingMixin, generate, save, load, load_needed
+from instrument import InstrumentMixin
 import copy
 import random
 import subprocess
@@ -23,12 +26,33 @@ def inputgen(pid, num_tups):
 def output(rel, path=""):
     print "Result: ", rel
 
-def protocol(rt, Zp, num_tups):
+def preprocess(rt, path):
+
+    def generated(pool):
+        save(pool, path)
+        rt.shutdown()
+
+    d = generate(rt, load_needed(path + ".needed"))
+    d.addCallback(generated)
+
+def protocol(rt, Zp, num_tups, options):
     ext = Rel(rt)
-    selected_input = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1])
+    selected_input = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1],
+        preagg=(0, 1) if options.preagg else None)
     aggregated = ext.aggregate_sum(selected_input, 0, 1, True)
     gathered = ext.gather(aggregated, [0, 1], [1, 2, 3])
     ext.outputwith(gathered, output)
+    if options.offline:
+        preprocess(rt, "%s-%d" % (options.offline, rt.id))
+        return
+    if options.record:
+        rt.record_draws("%s-%d.needed" % (options.record, rt.id))
+    if options.preprocessed:
+        rt.use_preprocessed(load("%s-%d" % (options.preprocessed, rt.id)))
+    if options.report:
+        rt.instrument("%s-%d.json" % (options.report, rt.id),
+            "%s-%d.trace.json" % (options.report, rt.id)
+            if options.trace else None)
     ext.finish()
 
 def report_error(err):
@@ -36,18 +60,35 @@ def report_error(err):
 
 if __name__ == "__main__":
     parser = OptionParser()
+    parser.add_option("--record", metavar="PREFIX",
+        help="write the draws of this run to PREFIX-<id>.needed")
+    parser.add_option("--offline", metavar="PREFIX",
+        help="only generate the draws recorded in PREFIX-<id>.needed, "
+             "into PREFIX-<id>")
+    parser.add_option("--preprocessed", metavar="PREFIX",
+        help="use the preprocessed randomness in PREFIX-<id>")
+    parser.add_option("--preagg", action="store_true", default=False,
+        help="sum each player's rows per key before sharing them")
+    parser.add_option("--report", metavar="PREFIX",
+        help="write the costs per operator to PREFIX-<id>.json")
+    parser.add_option("--trace", action="store_true", default=False,
+        help="with --report, also write trace events to "
+             "PREFIX-<id>.trace.json")
     Runtime.add_options(parser)
     options, args = parser.parse_args()
     pid, players = load_config(args[0])
     num_tups = int(args[1])
     Zp = GF(find_prime(2**65, blum=True))
     
+    # The mixins overriding PassiveRuntime must come before it
     runtime_class = make_runtime_class(
+        runtime_class=type("InstrumentedRuntime",
+            (InstrumentMixin, PreprocessingMixin, PassiveRuntime), {}),
         mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
     )
     pre_runtime = create_runtime(pid, players, 1, options, 
         runtime_class=runtime_class)
-    pre_runtime.addCallback(protocol, Zp, num_tups)
+    pre_runtime.addCallback(protocol, Zp, num_tups, options)
     pre_runtime.addErrback(report_error)
 
     reactor.run()
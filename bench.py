@@ -0,0 +1,189 @@
+from optparse import OptionParser
+import csv
+import json
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs the example protocols with three players on localhost over a range
+# of input sizes and writes wall time, peak RSS and bytes exchanged per
+# player to a CSV file, e.g.
+#
+#   python bench.py --sizes 100,1000 --runs 3 --out new.csv
+#   python bench.py --sizes 100,1000 --runs 3 --baseline old.csv
+#
+# With a baseline, every case whose median wall time (of the slowest
+# player) is more than --threshold percent above the baseline is reported,
+# and the exit status is 1. Every player runs in its own process, through
+# this script with --player, which counts the bytes it sends and receives.
+
+SCRIPTS = ['example.py', 'aggpub.py', 'aggpriv.py', 'joinpub.py',
+           'joinpriv.py']
+
+FIELDS = ['script', 'num_tups', 'run', 'player', 'wall_seconds',
+          'peak_rss_kb', 'bytes_sent', 'bytes_received']
+
+def run_player(stats_path, argv):
+    # Runs the script in argv as player, counting the bytes of all VIFF
+    # messages once the script has installed the VIFF reactor
+    import viff.reactor
+    from scheduler import peak_rss
+    counts = {'bytes_sent': 0, 'bytes_received': 0}
+    install = viff.reactor.install
+
+    def counting_install():
+        reactor = install()
+        from viff.runtime import ShareExchanger
+        send, receive = ShareExchanger.sendString, ShareExchanger.stringReceived
+
+        def sendString(self, string):
+            counts['bytes_sent'] += len(string)
+            return send(self, string)
+
+        def stringReceived(self, string):
+            counts['bytes_received'] += len(string)
+            return receive(self, string)
+
+        ShareExchanger.sendString = sendString
+        ShareExchanger.stringReceived = stringReceived
+        return reactor
+
+    viff.reactor.install = counting_install
+    sys.argv = argv
+    start = time.time()
+    try:
+        runpy.run_path(argv[0], run_name='__main__')
+    finally:
+        counts['wall_seconds'] = round(time.time() - start, 3)
+        counts['peak_rss_kb'] = peak_rss()
+        out = open(stats_path, 'w')
+        json.dump(counts, out)
+        out.close()
+
+def write_configs(workdir, port, n=3, t=1):
+    from viff.config import generate_configs
+    addresses = [['localhost', str(port + i)] for i in range(n)]
+    configs = generate_configs(n, t, addresses,
+                               os.path.join(workdir, 'player'))
+    paths = []
+    for player in sorted(configs):
+        configs[player].write()
+        paths.append(configs[player].filename)
+    return paths
+
+def run_case(script, num_tups, run, port, timeout):
+    """Runs *script* with all players on *num_tups* rows and returns a row
+       of results per player.
+       """
+    workdir = tempfile.mkdtemp(prefix='riff-bench-')
+    try:
+        procs, stats = [], []
+        for config in write_configs(workdir, port):
+            stats.append(config + '.json')
+            log = open(config + '.log', 'w')
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--player',
+                 stats[-1], script, config, str(num_tups), '--no-ssl'],
+                stdout=log, stderr=subprocess.STDOUT))
+        deadline = time.time() + timeout
+        while any(proc.poll() is None for proc in procs):
+            if time.time() > deadline:
+                for proc in procs:
+                    if proc.poll() is None:
+                        proc.kill()
+                raise RuntimeError("%s on %d rows timed out"
+                                   % (script, num_tups))
+            time.sleep(0.1)
+        rows = []
+        for player, (proc, path) in enumerate(zip(procs, stats)):
+            if proc.returncode != 0 or not os.path.exists(path):
+                raise RuntimeError("Player %d of %s on %d rows failed, see %s"
+                                   % (player + 1, script, num_tups,
+                                      path[:-len('.json')] + '.log'))
+            result = json.load(open(path))
+            result.update(script=script, num_tups=num_tups, run=run,
+                          player=player + 1)
+            rows.append(result)
+        return rows
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def median(vals):
+    vals = sorted(vals)
+    mid = len(vals) // 2
+    return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2.0
+
+def wall_times(rows):
+    # Median over runs of the wall time of the slowest player, per case
+    slowest = {}
+    for row in rows:
+        case = (row['script'], int(row['num_tups']))
+        run = slowest.setdefault(case, {})
+        run[row['run']] = max(run.get(row['run'], 0),
+                              float(row['wall_seconds']))
+    return dict((case, median(runs.values()))
+                for case, runs in slowest.items())
+
+def compare(rows, baseline, threshold):
+    """Returns the cases that are more than *threshold* percent slower than
+       in *baseline*, as (script, num_tups, baseline time, time).
+       """
+    before, after = wall_times(baseline), wall_times(rows)
+    return [case + (before[case], after[case]) for case in sorted(after)
+            if case in before
+            and after[case] > before[case] * (1 + threshold / 100.0)]
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--scripts", default=','.join(SCRIPTS),
+        help="comma separated protocols to run [default: %default]")
+    parser.add_option("--sizes", default="10,100,1000",
+        help="comma separated numbers of rows [default: %default]")
+    parser.add_option("--runs", type="int", default=3,
+        help="runs per script and size [default: %default]")
+    parser.add_option("--out", default="bench.csv",
+        help="CSV file for the results [default: %default]")
+    parser.add_option("--baseline", metavar="CSV",
+        help="results of an earlier run to compare against")
+    parser.add_option("--threshold", type="float", default=10,
+        help="percent slowdown reported as a regression [default: %default]")
+    parser.add_option("--port", type="int", default=9000,
+        help="first port to use [default: %default]")
+    parser.add_option("--timeout", type="int", default=600,
+        help="seconds before a run is killed [default: %default]")
+    options, args = parser.parse_args()
+
+    rows, port = [], options.port
+    for script in options.scripts.split(','):
+        for num_tups in [int(size) for size in options.sizes.split(',')]:
+            for run in range(options.runs):
+                # Fresh ports, as the last ones may still be in TIME_WAIT
+                port += 10
+                rows.extend(run_case(script, num_tups, run, port,
+                                     options.timeout))
+                print "%s on %d rows, run %d: %.3fs" % (script, num_tups,
+                    run, max([row['wall_seconds'] for row in rows[-3:]]))
+    out = open(options.out, 'wb')
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writerow(dict(zip(FIELDS, FIELDS)))
+    writer.writerows(rows)
+    out.close()
+
+    if options.baseline:
+        baseline = list(csv.DictReader(open(options.baseline, 'rb')))
+        slower = compare(rows, baseline, options.threshold)
+        for script, num_tups, before, after in slower:
+            print "SLOWER: %s on %d rows took %.3fs, baseline %.3fs" % \
+                (script, num_tups, after, before)
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--player':
+        run_player(sys.argv[2], sys.argv[3:])
+    else:
+        main()
@@ -0,0 +1,72 @@
+from optparse import OptionParser
+import viff.reactor
+viff.reactor.install()
+from twisted.internet import reactor
+
+from viff.field import GF
+from viff.runtime import make_runtime_class, create_runtime, Runtime
+from viff.comparison import ComparisonToft07Mixin
+from viff.equality import ProbabilisticEqualityMixin
+from viff.config import load_config
+from viff.util import find_prime
+
+from extensions import Rel, divide
+import random
+import sys
+import time
+
+# Times dividing one column by another for num_tups private rows, e.g.
+#
+#   python benchdivide.py player-1.ini 1000 newton
+#
+# with method either row (divide called per row in a project, as before),
+# bitwise (the default) or newton. Player 1 also reports the largest error.
+
+L = 12
+
+def inputgen(pid, num_tups):
+    return [(random.randint(0, 2**L - 1), random.randint(1, 2**L - 1))
+            for _ in range(num_tups)] if pid == 1 else []
+
+def report(rel, rows, method, start):
+    print "Divided %d rows with %s in %.3fs" % \
+        (len(rel), method, time.time() - start)
+    if rows:
+        print "Largest error: %.3f" % max([abs(q - float(x) / y)
+            for (x, y), (q, _) in zip(rows, rel)])
+
+def protocol(rt, Zp, num_tups, method):
+    ext = Rel(rt)
+    rows = inputgen(rt.id, num_tups)
+    selected_input = ext.scatter(rows, Zp, [1, 1])
+    if method == 'row':
+        divided = ext.project(selected_input,
+            lambda x, y: [divide(x, y, L), y])
+    else:
+        divided = ext.divide(selected_input, 0, 1, L, method)
+    gathered = ext.gather(divided, [0, 1], [1, 2, 3])
+    start = time.time()
+    ext.outputwith(gathered, lambda rel: report(rel, rows, method, start))
+    ext.finish()
+
+def report_error(err):
+    sys.stderr.write(str(err))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    Runtime.add_options(parser)
+    options, args = parser.parse_args()
+    pid, players = load_config(args[0])
+    num_tups = int(args[1])
+    method = args[2] if len(args) > 2 else 'bitwise'
+    Zp = GF(find_prime(2**65, blum=True))
+
+    runtime_class = make_runtime_class(
+        mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
+    )
+    pre_runtime = create_runtime(pid, players, 1, options,
+        runtime_class=runtime_class)
+    pre_runtime.addCallback(protocol, Zp, num_tups, method)
+    pre_runtime.addErrback(report_error)
+
+    reactor.run()
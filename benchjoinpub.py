@@ -0,0 +1,55 @@
+from optparse import OptionParser
+import random
+import time
+
+from extensions import Rel
+
+# Benchmarks the public-key join (Rel._open_join) against the nested loop
+# it replaced. Both run on opened (plain int) relations, so no runtime is
+# needed.
+
+def nested_loop_join(rel, other_rel, join_col, other_join_col):
+    result = []
+    for row in rel:
+        for other_row in other_rel:
+            if row[join_col] == other_row[other_join_col]:
+                result_row = [row[join_col]] \
+                           + [val for idx, val in enumerate(row) if idx != join_col] \
+                           + [val for idx, val in enumerate(other_row) if idx != other_join_col]
+                result.append(result_row)
+    return result
+
+def inputgen(num_tups, num_keys):
+    return [(random.randint(0, num_keys - 1), random.randint(0, 100))
+            for _ in range(num_tups)]
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [num_tups ...]")
+    parser.add_option("--keys", type="int", default=None,
+        help="number of distinct join keys (default: num_tups)")
+    parser.add_option("--max-loop", type="int", default=10000,
+        help="largest input size to run the nested loop on")
+    options, args = parser.parse_args()
+    sizes = [int(arg) for arg in args] or [1000, 10000, 100000]
+    ext = Rel(None)
+
+    for num_tups in sizes:
+        num_keys = options.keys or num_tups
+        rel = inputgen(num_tups, num_keys)
+        other_rel = inputgen(num_tups, num_keys)
+        joined, hash_time = timed(
+            ext._open_join, [(True, rel), (True, other_rel)], 0, 0)
+        if num_tups <= options.max_loop:
+            expected, loop_time = timed(
+                nested_loop_join, rel, other_rel, 0, 0)
+            assert joined == expected
+            print "%d rows: hash %.3fs, loop %.3fs (%d matches)" % \
+                (num_tups, hash_time, loop_time, len(joined))
+        else:
+            print "%d rows: hash %.3fs, loop skipped (%d matches)" % \
+                (num_tups, hash_time, len(joined))
@@ -0,0 +1,78 @@
+from optparse import OptionParser
+import viff.reactor
+viff.reactor.install()
+from twisted.internet import reactor
+
+from viff.field import GF
+from viff.runtime import make_runtime_class, create_runtime, Runtime
+from viff.comparison import ComparisonToft07Mixin
+from viff.equality import ProbabilisticEqualityMixin
+from viff.config import load_config
+from viff.util import find_prime
+
+from extensions import Rel
+from scheduler import peak_rss
+import random
+import sys
+import time
+
+# Reports the peak RSS of a pipeline of num_stages stages, each a
+# projection and a private join with a small relation, e.g.
+#
+#   python benchmemory.py player-1.ini 1000 8
+#   python benchmemory.py player-1.ini 1000 8 keep
+#
+# With keep, every intermediate relation is kept until the end of the run,
+# which shows how much releasing them saves.
+
+NUM_KEYS = 10
+
+def inputgen(pid, num_tups):
+    return [(random.randint(0, NUM_KEYS - 1), random.randint(0, 100))
+            for _ in range(num_tups)] if pid == 1 else []
+
+def keygen(pid):
+    return [(key, 1) for key in range(NUM_KEYS)] if pid == 1 else []
+
+def report(rel, num_stages, keep, start):
+    print "%d stages over %d rows in %.3fs (%s), peak RSS %d KB" % \
+        (num_stages, len(rel), time.time() - start,
+         "kept" if keep else "released", peak_rss())
+
+def protocol(rt, Zp, num_tups, num_stages, keep):
+    ext = Rel(rt)
+    ext.keep_results = keep
+    rel = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1])
+    for _ in range(num_stages):
+        rel = ext.project(rel, lambda key, val: [key, val + 1])
+        keys = ext.scatter(keygen(rt.id), Zp, [1, 1])
+        rel = ext.join(keys, rel, 0, 0, True, is_key_unique=True)
+        rel = ext.project(rel, lambda key, inc, val: [key, val + inc])
+    gathered = ext.gather(rel, [0, 1], [1, 2, 3])
+    start = time.time()
+    ext.outputwith(gathered,
+        lambda rel: report(rel, num_stages, keep, start))
+    ext.finish()
+
+def report_error(err):
+    sys.stderr.write(str(err))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    Runtime.add_options(parser)
+    options, args = parser.parse_args()
+    pid, players = load_config(args[0])
+    num_tups = int(args[1])
+    num_stages = int(args[2]) if len(args) > 2 else 8
+    keep = len(args) > 3 and args[3] == 'keep'
+    Zp = GF(find_prime(2**65, blum=True))
+
+    runtime_class = make_runtime_class(
+        mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
+    )
+    pre_runtime = create_runtime(pid, players, 1, options,
+        runtime_class=runtime_class)
+    pre_runtime.addCallback(protocol, Zp, num_tups, num_stages, keep)
+    pre_runtime.addErrback(report_error)
+
+    reactor.run()
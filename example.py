@@ -23,9 +23,10 @@ def inputgen(pid, num_tups):
 def output(rel, path=""):
     print "Result: ", len(rel)
 
-def protocol(rt, Zp, num_tups):
+def protocol(rt, Zp, num_tups, chunk_size):
     ext = Rel(rt)
-    selected_input = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1])
+    selected_input = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1],
+        chunk_size=chunk_size)
     gathered = ext.gather(selected_input, [0, 1], [1, 2, 3])
     ext.outputwith(gathered, output)
     ext.finish()
@@ -39,6 +40,7 @@ if __name__ == "__main__":
     options, args = parser.parse_args()
     pid, players = load_config(args[0])
     num_tups = int(args[1])
+    chunk_size = int(args[2]) if len(args) > 2 else None
     Zp = GF(find_prime(2**65, blum=True))
     
     runtime_class = make_runtime_class(
@@ -46,7 +48,7 @@ if __name__ == "__main__":
     )
     pre_runtime = create_runtime(pid, players, 1, options, 
         runtime_class=runtime_class)
-    pre_runtime.addCallback(protocol, Zp, num_tups)
+    pre_runtime.addCallback(protocol, Zp, num_tups, chunk_size)
     pre_runtime.addErrback(report_error)
 
     reactor.run()
@@ -1,9 +1,18 @@
-from viff.runtime import gather_shares
-from twisted.internet.defer import Deferred, DeferredList
-from math import floor, log
+from viff.runtime import gather_shares, Share, SHARE
+from viff import shamir
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.python.failure import Failure
+from math import ceil, floor, log
 from collections import deque
+from itertools import combinations
+from plan import make_node, optimize, explain, totals
+from scheduler import Scheduler, schedule_forked
+from instrument import labelled, operation
 import random
 
+# Values opened or shared per message, which are limited to 64 KB
+OPEN_BATCH = 2000
+
 # Taken directly from VIFF
 def bits_to_val(bits):
     return sum([2**i * b for (i, b) in enumerate(reversed(bits))])
@@ -35,6 +44,84 @@ def divide(x, y, l=12):
         x = x - t * cmp
     return bits_to_val(bits)
 
+@operation('divide')
+def divide_column(xs, ys, l=12):
+    """Returns ``divide(x, y, l)`` for every pair of *xs* and *ys*, with
+       the same precondition and result. The i-th comparisons of all pairs
+       are issued together, so the whole column takes *l* + 1 rounds of
+       comparison.
+       """
+    xs = list(xs)
+    bits = [[] for _ in xs]
+    for i in range(l, -1, -1):
+        ts = [2**i * y for y in ys]
+        cmps = [t <= x for t, x in zip(ts, xs)]
+        for idx, cmp in enumerate(cmps):
+            bits[idx].append(cmp)
+            xs[idx] = xs[idx] - ts[idx] * cmp
+    return [bits_to_val(val_bits) for val_bits in bits]
+
+def truncate(vals, m, k):
+    """Returns shares of ``val / 2**m`` for the shares *vals* of values in
+       ``[0, 2**k)``, each rounded up or down at random (probabilistic
+       truncation by Catrina and Saxena).
+
+       Precondition: ``2**(k + kappa + 1) < field.modulus``, with kappa
+       the security parameter.
+
+       Communication cost: *k* + kappa random bits and one opening per
+       value, all in parallel.
+       """
+    rt = vals[0].runtime
+    field = vals[0].field
+    num_bits = k + rt.options.security_parameter
+    assert field.modulus > 2**(num_bits + 1), "Field too small"
+    bits = rt.prss_share_random_multi(field, len(vals) * num_bits,
+                                      binary=True)
+    inv = ~field(2**m)
+    result = []
+    for idx, val in enumerate(vals):
+        val_bits = bits[idx * num_bits:(idx + 1) * num_bits]
+        r_low = sum([2**j * b for j, b in enumerate(val_bits[:m])])
+        r = r_low + sum([2**j * b for j, b in enumerate(val_bits[m:], m)])
+        c_low = rt.open(val + r)
+        c_low.addCallback(lambda c: field(c.value % 2**m))
+        result.append((val + r_low - c_low) * inv)
+    return result
+
+def reciprocal(ys, l=12, f=15):
+    """Returns shares of about ``2**f / y`` for the shares *ys* of values
+       in ``[1, 2**l)``, computed by Newton-Raphson iteration from
+       ``2**(f - l)``.
+
+       Precondition: ``l <= f`` and ``2**(2*f + 3 + kappa) <
+       field.modulus``.
+
+       Every result is within 2 of ``2**f / y``.
+       """
+    iterations = int(ceil(l + log((f + 1) * log(2), 2)))
+    ws = [2**(f - l) for _ in ys]
+    for _ in range(iterations):
+        us = [2**(f + 1) - y * w for y, w in zip(ys, ws)]
+        ws = truncate([w * u for w, u in zip(ws, us)], f, 2 * f + 2)
+    return ws
+
+@operation('divide')
+def divide_newton(xs, ys, l=12, f=15):
+    """Returns shares of about ``x/y`` for every pair of *xs* in ``[0,
+       2**l)`` and *ys* in ``[1, 2**l)``, using only multiplications and
+       truncations.
+
+       Precondition: ``l <= f``, ``2**(2*f + 3 + kappa) < field.modulus``
+       and ``2**(l + f + 2 + kappa) < field.modulus``.
+
+       Every result differs from ``x/y`` by less than
+       ``1 + 2**(l + 1 - f)``, so with the defaults it is ``x/y`` rounded
+       up or down.
+       """
+    ws = reciprocal(ys, l, f)
+    return truncate([x * w for x, w in zip(xs, ws)], f, l + f + 1)
+
 def simple_sort(rel, key):
     
     def cond_swap(x, y, key):
@@ -54,13 +141,17 @@ def simple_sort(rel, key):
     return res_rel
 
 # Taken from VIFF with minor modification
-def sort(rel, key, ascending=True):
-    # Make a shallow copy -- the algorithm wont be in-place anyway
-    # since we create lots of new Shares as we go along.
-    if len(rel) < 2:
-        return rel
-    
-    rel = rel[:]
+def bitonic_layers(n, ascending=True, merge_only=False):
+    """Returns the compare-exchanges ``(i, j, ascending)`` of the bitonic
+       sorting network on *n* elements, grouped into layers. Each layer
+       only depends on the layers before it, so all of its
+       compare-exchanges can be issued at once.
+
+       With *merge_only*, returns just the final merge network, which
+       sorts any sequence that is sorted against *ascending* up to some
+       position and along it from there.
+       """
+    comparators = []
 
     def bitonic_sort(low, n, ascending):
         if n > 1:
@@ -74,19 +165,132 @@ def sort(rel, key, ascending=True):
             # Choose m as the greatest power of 2 less than n.
             m = 2**int(floor(log(n-1, 2)))
             for i in range(low, low + n - m):
-                compare(i, i+m, ascending)
+                comparators.append((i, i+m, ascending))
             bitonic_merge(low, m, ascending)
             bitonic_merge(low + m, n - m, ascending)
 
-    def compare(i, j, ascending):
+    if merge_only:
+        bitonic_merge(0, n, ascending)
+    else:
+        bitonic_sort(0, n, ascending)
+    return layered(comparators, n)
+
+def layered(comparators, n):
+    # Places every compare-exchange in the earliest layer after the last
+    # one touching either of its elements
+    layers, depth = [], [0] * n
+    for i, j, ascending in comparators:
+        layer = max(depth[i], depth[j])
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append((i, j, ascending))
+        depth[i] = depth[j] = layer + 1
+    return layers
+
+def pack(vals, widths):
+    """Packs *vals* into one value, the first one in the most significant
+       position, given that ``0 <= vals[i] < 2**widths[i]``. Packing keeps
+       the lexicographic order of the values.
+       """
+    packed = 0
+    for val, width in zip(vals, widths):
+        packed = packed * 2**width + val
+    return packed
+
+def less_equal(x, y):
+    # Lexicographic if x and y are sequences: one comparison and one
+    # equality test per position
+    if not isinstance(x, (list, tuple)):
+        return x <= y
+    le = x[-1] <= y[-1]
+    for a, b in zip(reversed(x[:-1]), reversed(y[:-1])):
+        le = (a < b) + (a == b) * le
+    return le
+
+def equals(x, y):
+    if not isinstance(x, (list, tuple)):
+        return x == y
+    eq = 1
+    for a, b in zip(x, y):
+        eq = eq * (a == b)
+    return eq
+
+def count_messages(rt, counts):
+    """Counts the messages, and their bytes, that *rt* sends for the
+       operations issued from now on until the returned function is
+       called, including those sent later in callbacks of these
+       operations. The counts are added to ``counts['messages']`` and
+       ``counts['bytes sent']`` as the messages go out.
+       """
+    # As in VIFF, every operation increments the program counter and
+    # runs, as do its callbacks, in a fork of it. The messages of the
+    # operations are hence those whose program counter extends the
+    # current one, but for a last part in the range of the operations.
+    ranges = getattr(rt, 'message_ranges', None)
+    if ranges is None:
+        ranges = rt.message_ranges = {}
+        for protocol in rt.protocols.values():
+            protocol.sendData = counting_send(ranges, protocol.sendData)
+    prefix, first = tuple(rt.program_counter[:-1]), rt.program_counter[-1]
+    counts['messages'] = counts['bytes sent'] = 0
+
+    def stop():
+        ranges.setdefault(prefix, []).append(
+            (first, rt.program_counter[-1], counts))
+
+    return stop
+
+def counting_send(ranges, send):
+
+    def send_counted(program_counter, data_type, data):
+        pc = tuple(program_counter)
+        for depth in range(1, len(pc)):
+            for first, last, counts in ranges.get(pc[:depth], ()):
+                if first < pc[depth] <= last:
+                    counts['messages'] += 1
+                    counts['bytes sent'] += len(str(data))
+        return send(program_counter, data_type, data)
+
+    return send_counted
+
+@operation('sort')
+def sort(rel, key, ascending=True, stats=None, method='bitonic',
+         layers=None, scheduler=None):
+    """Sorts *rel* by *key* with a bitonic sorting network, one layer of
+       compare-exchanges at a time.
+
+       If *stats* is a list, a dict with the number of comparisons and
+       secure multiplications is appended to it for every layer, and
+       with the messages and bytes sent for the layer, which are counted
+       as they go out, see :func:`count_messages`. Each layer costs one
+       comparison round and one multiplication round.
+
+       If *key* returns sequences, rows are sorted lexicographically.
 
-        def xor(a, b):
-            # TODO: We use this simple xor until
-            # http://tracker.viff.dk/issue60 is fixed.
-            return a + b - 2*a*b
+       *layers* replaces the bitonic sorting network, see :func:`merge`.
 
-        le = key(rel[i]) <= key(rel[j])
-            
+       With a :class:`scheduler.Scheduler`, every layer is a batch of the
+       scheduler and a Deferred with the sorted rows is returned.
+
+       With ``method='shuffle'`` the relation is sorted by
+       :func:`shuffle_sort` instead, which needs single keys.
+       """
+    # Make a shallow copy -- the algorithm wont be in-place anyway
+    # since we create lots of new Shares as we go along.
+    if len(rel) < 2:
+        return rel
+    if method == 'shuffle':
+        return shuffle_sort(rel, key, ascending, stats)
+
+    rel = rel[:]
+    compare = lambda x, y: less_equal(key(x), key(y))
+
+    def xor(a, b):
+        # TODO: We use this simple xor until
+        # http://tracker.viff.dk/issue60 is fixed.
+        return a + b - 2*a*b
+
+    def exchange(i, j, ascending, le):
         # We must swap array[i] and array[j] when they sort in the
         # wrong direction, that is, when ascending is True and
         # array[i] > array[j], or when ascending is False (meaning
@@ -108,19 +312,356 @@ def sort(rel, key, ascending=True):
 
         rel[i] = [x - b_x_y for x, b_x_y in zip(ai, b_ai_aj)]
         rel[j] = [y + b_x_y for y, b_x_y in zip(aj, b_ai_aj)]
-        
-    bitonic_sort(0, len(rel), ascending=ascending)
-    return rel
+
+    # The runtime whose messages are counted, if any
+    rt = None
+    if stats is not None:
+        rt = next((val.runtime for row in rel for val in row
+                   if isinstance(val, Share)), None)
+
+    def run_layer(layer):
+        # All comparisons of a layer are issued before any of its swaps,
+        # so that the layer's messages go out together
+        layer_stats = {
+            'comparisons': len(layer),
+            'multiplications': len(layer) * len(rel[0])
+        }
+        if rt is not None:
+            stop = count_messages(rt, layer_stats)
+        les = [compare(rel[i], rel[j]) for i, j, _ in layer]
+        for (i, j, ascending), le in zip(layer, les):
+            exchange(i, j, ascending, le)
+        if rt is not None:
+            stop()
+        if stats is not None:
+            stats.append(layer_stats)
+        return [rel[idx] for i, j, _ in layer for idx in (i, j)]
+
+    def sorted_rel(_=None):
+        return rel
+
+    if layers is None:
+        layers = bitonic_layers(len(rel), ascending)
+    if scheduler is not None:
+        stream = scheduler.stream()
+        done = [stream.submit(run_layer, layer) for layer in layers]
+        return schedule_forked(scheduler.rt, DeferredList(done), sorted_rel)
+    for layer in layers:
+        run_layer(layer)
+    return sorted_rel()
+
+def merge(rel, other_rel, key, ascending=True, stats=None):
+    """Merges *rel* and *other_rel*, both sorted by *key*, into one sorted
+       relation with the bitonic merge network: about ``n/2 log n``
+       comparisons in log n layers for n rows in total, rather than the
+       ``n/4 log**2 n`` of sorting from scratch.
+       """
+    rows = list(reversed(rel)) + list(other_rel)
+    return sort(rows, key, ascending, stats,
+                layers=bitonic_layers(len(rows), ascending, merge_only=True))
+
+def topk_layers(n, k, ascending=True):
+    """Returns the layers of a network of compare-exchanges that moves
+       the first *k* of *n* rows in sorted order to the front.
+
+       The rows are sorted in blocks of k with the bitonic sorting
+       network, and the blocks are then merged pairwise in a tournament.
+       To merge two sorted blocks, every row of the first is compared
+       with the row at the mirrored position of the second and the
+       better one is kept. The kept rows are the first k of both blocks
+       and form a bitonic sequence, which the bitonic merge network
+       sorts. The blocks of a round are merged side by side.
+
+       Communication cost: about ``n/4 log**2 k`` comparisons to sort the
+       blocks and ``n/k - 1`` merges of about ``k + k/2 log k``
+       comparisons each, see :func:`topk_comparisons`.
+       """
+    if k < 1:
+        raise ValueError("k must be positive")
+    comparators = []
+
+    def add(layers, positions):
+        for layer in layers:
+            comparators.extend([(positions[i], positions[j], asc)
+                                for i, j, asc in layer])
+
+    blocks = [range(start, min(start + k, n)) for start in range(0, n, k)]
+    for block in blocks:
+        add(bitonic_layers(len(block), ascending), block)
+    while len(blocks) > 1:
+        merged = []
+        for first, second in zip(blocks[::2], blocks[1::2]):
+            # A short last block counts as padded with rows worse than
+            # any other, which needs no compare-exchange
+            comparators.extend([(first[k - 1 - i], second[i], ascending)
+                                for i in range(len(second))])
+            # The kept rows rise and fall (or the other way round), so
+            # they are merged back to front in the opposite direction
+            add(bitonic_layers(k, not ascending, merge_only=True),
+                first[::-1])
+            merged.append(first)
+        if len(blocks) % 2:
+            merged.append(blocks[-1])
+        blocks = merged
+    return layered(comparators, n)
+
+def topk_comparisons(n, k):
+    """Returns the number of comparisons of :func:`topk` on *n* rows,
+       without building its network.
+       """
+    if k < 1:
+        raise ValueError("k must be positive")
+    size = lambda layers: sum([len(layer) for layer in layers])
+    if n <= k:
+        return size(bitonic_layers(n))
+    blocks = [k] * (n // k) + ([n % k] if n % k else [])
+    total = n // k * size(bitonic_layers(k)) + size(bitonic_layers(n % k))
+    merge = size(bitonic_layers(k, merge_only=True))
+    while len(blocks) > 1:
+        total += sum([second + merge for second in blocks[1::2]])
+        blocks = [k] * (len(blocks) // 2) + blocks[len(blocks) // 2 * 2:]
+    return total
+
+def topk(rel, key, k, ascending=True, stats=None, scheduler=None):
+    """Returns the first *k* rows of *rel* sorted by *key*, i.e., the
+       smallest ones, or the largest ones unless *ascending*, without
+       sorting all of *rel*, see :func:`topk_layers`.
+
+       The other arguments are those of :func:`sort`; with a scheduler, a
+       Deferred with the rows is returned.
+       """
+    if len(rel) <= k:
+        return sort(rel, key, ascending, stats, scheduler=scheduler)
+    rows = sort(rel, key, ascending, stats,
+                layers=topk_layers(len(rel), k, ascending),
+                scheduler=scheduler)
+    if scheduler is not None:
+        return schedule_forked(scheduler.rt, rows, lambda rows: rows[:k])
+    return rows[:k]
+
+def shuffle(rt, field, rel):
+    """Returns a Deferred with the rows of *rel* under a random
+       permutation that no coalition of up to ``rt.threshold`` players
+       knows.
+
+       The permutation is composed of one permutation per PRSS subset of
+       players. The members of a subset turn their shares into additive
+       shares, permute these locally with a permutation derived from the
+       subset's PRSS key, and share them anew. Every coalition of up to
+       threshold players misses at least one subset, so none of them
+       learns the composition.
+       """
+    n, width = len(rel), len(rel[0])
+    subsets = list(combinations(
+        sorted(rt.players), len(rt.players) - rt.threshold))
+
+    def reshare(values, subset):
+        if rt.id in subset:
+            # Fisher-Yates, driven by the subset's PRF. Its outputs are
+            # so much larger than n that reducing them is as good as
+            # uniform.
+            prf = rt.players[rt.id].prfs(2**128)[frozenset(subset)]
+            pc = tuple(rt.program_counter)
+            order = range(n)
+            for i in range(n - 1, 0, -1):
+                j = prf(pc + (i,)) % (i + 1)
+                order[i], order[j] = order[j], order[i]
+            # Lagrange coefficient turning our share into an additive one
+            coeff = field(1)
+            for other_id in subset:
+                if other_id != rt.id:
+                    coeff *= field(other_id) / field(other_id - rt.id)
+            values = [coeff * values[row_idx * width + col]
+                      for row_idx in order for col in range(width)]
+        else:
+            values = [None] * (n * width)
+        return [sum(rt.shamir_share(list(subset), field, value))
+                for value in values]
+
+    d = gather_shares([val if isinstance(val, Share)
+                       else Share(rt, field, field(val))
+                       for row in rel for val in row])
+    for subset in subsets[:-1]:
+        d = schedule_forked(rt, d, reshare, subset)
+        d = schedule_forked(rt, d, gather_shares)
+    d = schedule_forked(rt, d, reshare, subsets[-1])
+    return schedule_forked(rt, d, lambda vals:
+        [vals[i:i + width] for i in range(0, n * width, width)])
+
+def shuffle_sort(rel, key, ascending=True, stats=None):
+    """Sorts *rel* by *key* by shuffling it with :func:`shuffle` and then
+       running a quicksort whose comparison results are opened.
+
+       The keys are made unique by appending the row index, i.e., rows
+       are compared on ``key * len(rel) + index``, which must fit in the
+       bit length used for comparisons. On distinct keys in random order
+       the opened comparisons reveal nothing about the input.
+
+       Returns rows of Shares that receive their values once sorting
+       completes, so it can be used in place of :func:`sort`. Rows with
+       public keys are sorted by :func:`sort` on the bitonic network, as
+       there is nothing to hide in their comparisons.
+
+       If *stats* is a list, a dict with the number of opened comparisons
+       is appended to it for every round of the quicksort, as the round
+       runs.
+
+       Communication cost: expected O(n log n) comparisons in O(log n)
+       rounds.
+       """
+    n = len(rel)
+    keys = [key(row) for row in rel if isinstance(key(row), Share)]
+    if not keys:
+        return sort(rel, key, ascending, stats)
+    rt, field = keys[0].runtime, keys[0].field
+    tagged = [list(row) + [key(row) * n + idx] for idx, row in enumerate(rel)]
+
+    def quicksort(rows):
+
+        def step(parts):
+            below = [rt.open(rows[idx][-1] < rows[part[0]][-1])
+                     for part in parts if len(part) > 1 for idx in part[1:]]
+            if not below:
+                return [rows[part[0]][:-1] for part in parts]
+            if stats is not None:
+                stats.append({'comparisons': len(below),
+                              'multiplications': 0})
+            return schedule_forked(rt, gather_shares(below), split, parts)
+
+        def split(below, parts):
+            below, new_parts = iter(below), []
+            for part in parts:
+                if len(part) < 2:
+                    new_parts.append(part)
+                    continue
+                lower, upper = [], []
+                for idx in part[1:]:
+                    if int(next(below)):
+                        lower.append(idx)
+                    else:
+                        upper.append(idx)
+                new_parts.extend([p for p in [lower, part[:1], upper] if p])
+            return step(new_parts)
+
+        return step([range(n)])
+
+    sorted_rel = schedule_forked(rt, shuffle(rt, field, tagged), quicksort)
+    result = [[Share(rt, field) for _ in row] for row in rel]
+
+    def fill(rows):
+        if not ascending:
+            rows.reverse()
+        for placeholders, row in zip(result, rows):
+            for placeholder, val in zip(placeholders, row):
+                val.chainDeferred(placeholder)
+
+    schedule_forked(rt, sorted_rel, fill)
+    return result
 
 def count(rel, cond):
     return sum([cond(row) for row in rel])
 
+def minimum(x, y):
+    if isinstance(x, (int, long)) and isinstance(y, (int, long)):
+        return min(x, y)
+    return x + (y < x) * (y - x)
+
+def maximum(x, y):
+    if isinstance(x, (int, long)) and isinstance(y, (int, long)):
+        return max(x, y)
+    return x + (x < y) * (y - x)
+
+# Aggregates by name: how to start a group from a value and how to add a
+# value to it
+AGGREGATES = {
+    'sum': (lambda val: val, lambda acc, val: acc + val),
+    'count': (lambda val: 1, lambda acc, val: acc + 1),
+    'min': (lambda val: val, minimum),
+    'max': (lambda val: val, maximum)
+}
+
+def prefix_scan(vals, op):
+    """Returns the inclusive prefix scan of *vals* under the associative
+       *op*, i.e., ``[vals[0], op(vals[0], vals[1]), ...]``.
+
+       Uses the Brent-Kung network: about 2n applications of *op*
+       arranged in 2 log n rounds, rather than a chain of n - 1.
+       """
+    vals = vals[:]
+    n, d = len(vals), 1
+    while d < n:
+        for i in range(2*d - 1, n, 2*d):
+            vals[i] = op(vals[i - d], vals[i])
+        d *= 2
+    while d > 1:
+        d //= 2
+        for i in range(3*d - 1, n, 2*d):
+            vals[i] = op(vals[i - d], vals[i])
+    return vals
+
+def compact(rel):
+    """Moves the rows of *rel* whose last entry (an indicator bit) is 1 to
+       the front, keeping their relative order. All other rows become zero
+       rows at the end.
+
+       Each row moves up by the number of dummy rows before it. The bits
+       of these offsets are computed from prefix XORs of the dummy bits
+       (bit 0) and of the carries out of the previous bit (higher bits).
+       The rows are then routed through log n levels, where level j moves
+       a row up by 2**j if bit j of its offset is set. Processing the bits
+       from least significant up, no two rows ever collide.
+
+       Communication cost: O(n log n) multiplications per column, and no
+       comparisons.
+       """
+    n = len(rel)
+    if n < 2:
+        return rel
+    width = len(rel[0]) - 1
+    levels = (n - 1).bit_length()
+
+    def xor(a, b):
+        return a + b - 2*a*b
+
+    offset_bits = []
+    dummies = [1 - row[-1] for row in rel]
+    for j in range(levels):
+        parity = prefix_scan(dummies, xor)
+        offset_bits.append(parity)
+        # The count of dummies up to i moves past a multiple of 2**(j+1)
+        # whenever a dummy is met while the count so far is odd
+        dummies = [0] + [dummy * odd
+                         for dummy, odd in zip(dummies[1:], parity[:-1])]
+
+    # Zero the dummy rows (and their offsets) so that a row moving onto
+    # a dummy's position simply replaces it
+    rows = [[row[-1] * val for val in row[:-1]] + [row[-1]]
+            + [row[-1] * bits[i] for bits in offset_bits]
+            for i, row in enumerate(rel)]
+
+    for j in range(levels):
+        shift = 2**j
+        moved = [[row[width + 1] * val
+                  for val in row[:width + 1] + row[width + 2:]]
+                 for row in rows]
+        rows = [[val - moved[i][c]
+                 + (moved[i + shift][c] if i + shift < n else 0)
+                 for c, val in enumerate(row[:width + 1] + row[width + 2:])]
+                for i, row in enumerate(rows)]
+    return rows
+
 # much deferred wow
 class MagicDeferred:
+    # The result of an operator, handed to each of its consumers through a
+    # child Deferred. Once every child has run its consumer's callbacks,
+    # the result is dropped (unless keep is set) and released fires, so
+    # that an intermediate relation only lives as long as it is needed.
 
-    def __init__(self, d):
+    def __init__(self, d, keep=False):
         self.children = []
         self.d = d
+        self.keep = keep
+        self.released = Deferred()
 
     def another(self):
         child = Deferred()
@@ -128,171 +669,629 @@ class MagicDeferred:
         return child
 
     def forward_callbacks(self, rt):
+        self.pending = len(self.children) + 1
 
         def forward_to(received, children):
             for child in children:
                 rt.handle_deferred_data(child, received)
+            self._consumed(None)
 
         rt.schedule_callback(self.d, forward_to, self.children)
 
+    def release_when_consumed(self):
+        # Must come after the forward_callbacks of all operators, as the
+        # child of one operator may be the result of the next
+        for child in self.children:
+            child.addBoth(self._consumed)
+
+    def _consumed(self, result):
+        self.pending -= 1
+        if self.pending == 0:
+            if not self.keep:
+                self.d, self.children = None, []
+            self.released.callback(None)
+        if isinstance(result, Failure) or self.keep:
+            return result
+
 def magic(f):
 
+    # Operators are only recorded here; they are scheduled by Rel.finish()
     def wrapper(self, *args, **kwargs):
-        md = MagicDeferred(f(self, *args, **kwargs))
-        self.mag_defs.append(md)
-        return md
+        node = make_node(f, self, args, kwargs)
+        self.plan.append(node)
+        return node
     
     return wrapper
 
 def cutofftail(f):
-    
-    def tail_len_received(tail_len, rel, rt, d):
-        without_indicator = [row[:-1] for row in rel]
-        rt.handle_deferred_data(d, without_indicator[0:len(rel) - int(tail_len)])
 
     def wrapper(self, *args, **kwargs):
-        result = f(self, *args, **kwargs)
-        sorted_by_val = sort(result, lambda x: x[-1], False)
-        tail_len = count(sorted_by_val, lambda x: x[-1] == 0)
-        if isinstance(tail_len, int):
-            without_indicator = [row[:-1] for row in sorted_by_val]
-            return without_indicator[0:len(sorted_by_val) - tail_len]
-        opened_tail_len = self.rt.open(tail_len)
-        d = Deferred()
-        self.rt.schedule_callback(opened_tail_len, tail_len_received, 
-            sorted_by_val, self.rt, d)
-        return d
+        compact = kwargs.pop('compact', True)
+
+        def cut(result):
+            if not compact:
+                return IndicatorRel([row[:-1] for row in result],
+                                    [row[-1] for row in result])
+            return labelled('cutofftail', lambda: self._cut(result))
+
+        return self._then(f(self, *args, **kwargs), cut)
     return wrapper
 
+class IndicatorRel(list):
+    """A relation that has been filtered lazily: only the rows whose
+       entry in *ind* is 1 belong to it. Operators whose cost or output
+       depends on the size of their input compact it first.
+       """
+
+    def __init__(self, rows, ind):
+        list.__init__(self, rows)
+        self.ind = ind
+
+class ChunkedRel:
+    """A relation that arrives in pieces: *chunks* is a list of Deferreds,
+       each firing with a list of rows. Operators that work row by row
+       process every chunk as soon as it arrives; all others wait for the
+       whole relation.
+       """
+
+    def __init__(self, chunks, padded=False):
+        self.chunks = chunks
+        # Whether chunks may carry indicators; such a relation is only
+        # compacted as a whole, so that the number of dropped rows per
+        # chunk stays hidden
+        self.padded = padded
+
 class Rel:
 
-    def __init__(self, rt):
+    def __init__(self, rt, window=None, batch_size=1000,
+                 defer_compaction=False):
+        # With a window, sorts, private nested-loop joins and chunked
+        # scatters run in batches (a sorting network layer, about
+        # batch_size rows, or a chunk), at most window of them per operator
+        # at a time; see self.scheduler.stats.
+        #
+        # With defer_compaction, private joins and aggregations neither
+        # compact their output nor their input: padded relations with an
+        # indicator per row flow through the pipeline and are only
+        # compacted by operators that need the exact rows, such as gather
+        # and the operators on public keys. This saves a sort and an
+        # opening per stage, at the price of larger intermediate results.
         self.rt = rt
+        self.defer_compaction = defer_compaction
         self.mag_defs = []
+        self.plan = []
+        self.optimized = False
+        self.scheduler = Scheduler(rt, window) if window else None
+        self.batch_size = batch_size
+        # With keep_results, intermediate relations are kept until the end
+        # of the run instead of as long as they have consumers
+        self.keep_results = False
+
+    def _cut(self, rel):
+        # Drops the rows of rel whose indicator (last column) is 0. Only
+        # the number of dropped rows is revealed.
+
+        def tail_len_received(tail_len, rel, d):
+            without_indicator = [row[:-1] for row in rel]
+            self.rt.handle_deferred_data(d,
+                without_indicator[0:len(rel) - int(tail_len)])
+
+        compacted = compact(rel)
+        # Indicators are bits, so counting the tail is linear
+        tail_len = count(compacted, lambda x: 1 - x[-1])
+        if isinstance(tail_len, int):
+            without_indicator = [row[:-1] for row in compacted]
+            return without_indicator[0:len(compacted) - tail_len]
+        opened_tail_len = self.rt.open(tail_len)
+        d = Deferred()
+        schedule_forked(self.rt, opened_tail_len, tail_len_received,
+            compacted, d)
+        return d
+
+    def _then(self, result, f, *args):
+        # Applies f to result, once it is there if it is a Deferred
+        if isinstance(result, Deferred):
+            return schedule_forked(self.rt, result, f, *args)
+        return f(result, *args)
+
+    def _fork(self, d):
+        # Lets several consumers add callbacks to the same Deferred
+        child = Deferred()
+
+        def forward(received):
+            self.rt.handle_deferred_data(child, received)
+            return received
+
+        d.addCallback(forward)
+        return child
+
+    def _per_chunk(self, rel, f, *args):
+        return ChunkedRel(
+            [schedule_forked(self.rt, self._fork(chunk), f, *args)
+             for chunk in rel.chunks], rel.padded)
+
+    def _concat(self, chunks):
+        rows, ind = [], []
+        for _, chunk in chunks:
+            rows.extend(chunk)
+            ind.extend(chunk.ind if isinstance(chunk, IndicatorRel)
+                       else [1] * len(chunk))
+        if any(isinstance(chunk, IndicatorRel) for _, chunk in chunks):
+            return IndicatorRel(rows, ind)
+        return rows
+
+    def _materialize(self, rel, cut=True):
+        # Without cut, an IndicatorRel is returned as it is
+        if isinstance(rel, ChunkedRel):
+            chunks = DeferredList([self._fork(chunk) for chunk in rel.chunks])
+            chunks.addCallback(self._handed_on)
+            concatenated = schedule_forked(self.rt, chunks, self._concat)
+            return schedule_forked(self.rt, concatenated, self._materialize,
+                                   cut)
+        if isinstance(rel, IndicatorRel) and cut:
+            return self._cut(
+                [list(row) + [ind] for row, ind in zip(rel, rel.ind)])
+        return rel
+
+    def _handed_on(self, results):
+        # A DeferredList keeps the list it fires with; hand on a copy so
+        # that the inputs can be freed once the consumer is done with them
+        received = list(results)
+        del results[:]
+        return received
+
+    def _compacted(self, rel):
+        return schedule_forked(self.rt, rel.another(), self._materialize)
+
+    def _private_input(self, rel):
+        # Input of a private join or aggregation, padded if compaction is
+        # deferred
+        return schedule_forked(self.rt, rel.another(), self._materialize,
+                               not self.defer_compaction)
+
+    def _indicators(self, rel):
+        # Strips the indicators of a padded relation: returns its rows and
+        # their indicators, or None for a relation without
+        if isinstance(rel, IndicatorRel):
+            return list(rel), rel.ind
+        return rel, None
+
+    def _sort_join(self, rel, other_rel, join_col, other_join_col):
+        # Requires the join keys of rel to be unique. Both relations are
+        # concatenated into rows of the form
+        #
+        #   [2*key + tag, key, present, rel vals, other_rel vals, tag]
+        #
+        # with tag 0 for rows of rel and 1 for rows of other_rel, and
+        # sorted once. Every row of rel then directly precedes the rows
+        # of other_rel that share its key, so its values (and the
+        # present flag) are copied down to them with a segmented prefix
+        # scan, in log depth rather than a chain through all rows.
+        #
+        # For padded inputs, present and the final tag hold the indicators
+        # instead, and the values of missing rows of rel are zeroed, so
+        # that they add nothing to the row of rel they share a key with.
+        if not rel or not other_rel:
+            return []
+        rel, ind = self._indicators(rel)
+        other_rel, other_ind = self._indicators(other_rel)
+        width, other_width = len(rel[0]) - 1, len(other_rel[0]) - 1
+        combined = []
+        for idx, row in enumerate(rel):
+            key = row[join_col]
+            vals = [val for col, val in enumerate(row) if col != join_col]
+            if ind is not None:
+                vals = [val * ind[idx] for val in vals]
+            combined.append(
+                [2 * key, key, 1 if ind is None else ind[idx]]
+                + vals + [0] * other_width + [0])
+        for idx, row in enumerate(other_rel):
+            key = row[other_join_col]
+            combined.append(
+                [2 * key + 1, key, 0] + [0] * width
+                + [val for col, val in enumerate(row) if col != other_join_col]
+                + [1 if other_ind is None else other_ind[idx]])
+
+        def propagate(combined):
+            flags = [combined[i][1] == combined[i - 1][1]
+                     for i in range(1, len(combined))]
+
+            # The rows of other_rel hold zeros in the columns of rel, so
+            # copying down is a segmented sum, as in _aggregate_sum
+            def seg_copy(e1, e2):
+                c1, v1 = e1
+                c2, v2 = e2
+                return c1 * c2, [b + c2 * a for a, b in zip(v1, v2)]
+
+            copied = prefix_scan(zip([0] + flags,
+                [row[2:3 + width] for row in combined]), seg_copy)
+            return [[row[1]] + vals[1:] + row[3 + width:-1]
+                    + [row[-1] * vals[0]]
+                    for row, (_, vals) in zip(combined, copied)]
+
+        return self._then(sort(combined, lambda x: x[0],
+                               scheduler=self.scheduler), propagate)
 
     @cutofftail
-    def _join(self, rels, join_col, other_join_col):
-        rel, other_rel, result = rels[0][1], rels[1][1], []
-        for row in rel:
-            for other_row in other_rel:
+    def _join(self, rels, join_col, other_join_col, is_key_unique=False):
+        rel, other_rel = rels[0][1], rels[1][1]
+        if is_key_unique:
+            return self._sort_join(rel, other_rel, join_col, other_join_col)
+        if self.scheduler is not None and other_rel:
+            step = max(self.batch_size // len(other_rel), 1)
+            return self.scheduler.map(
+                lambda rows: self._nested_join(rows, other_rel, join_col,
+                                               other_join_col),
+                [rel[start:start + step] if not isinstance(rel, IndicatorRel)
+                 else IndicatorRel(rel[start:start + step],
+                                   rel.ind[start:start + step])
+                 for start in range(0, len(rel), step)])
+        return self._nested_join(rel, other_rel, join_col, other_join_col)
+
+    def _nested_join(self, rel, other_rel, join_col, other_join_col):
+        # A pair of padded rows only matches if both are present
+        rel, ind = self._indicators(rel)
+        other_rel, other_ind = self._indicators(other_rel)
+        result = []
+        for idx, row in enumerate(rel):
+            for other_idx, other_row in enumerate(other_rel):
                 flag = row[join_col] == other_row[other_join_col]
+                if ind is not None:
+                    flag = flag * ind[idx]
+                if other_ind is not None:
+                    flag = flag * other_ind[other_idx]
                 result_row = [row[join_col]] \
-                           + [val for idx, val in enumerate(row) if idx != join_col] \
-                           + [val for idx, val in enumerate(other_row) if idx != other_join_col] \
+                           + [val for col, val in enumerate(row) if col != join_col] \
+                           + [val for col, val in enumerate(other_row) if col != other_join_col] \
                            + [flag]
                 result.append(result_row)
         return result
 
+    def _index(self, rel, key_col):
+        index = {}
+        for idx, row in enumerate(rel):
+            index.setdefault(row[key_col], []).append(idx)
+        return index
+
     def _open_join(self, rels, join_col, other_join_col):
-        rel, other_rel, result = rels[0][1], rels[1][1], []
-        for row in rel:
-            for other_row in other_rel:
-                if row[join_col] == other_row[other_join_col]:
-                    result_row = [row[join_col]] \
-                               + [val for idx, val in enumerate(row) if idx != join_col] \
-                               + [val for idx, val in enumerate(other_row) if idx != other_join_col]
-                    result.append(result_row)
+        # Hash join: build on the smaller relation, probe with the larger.
+        # Matches are collected per row of rel so that the output order is
+        # the same as that of a nested loop over rel and other_rel.
+        rel, other_rel = rels[0][1], rels[1][1]
+        if len(other_rel) <= len(rel):
+            index = self._index(other_rel, other_join_col)
+            matches = [index.get(row[join_col], []) for row in rel]
+        else:
+            index = self._index(rel, join_col)
+            matches = [[] for _ in rel]
+            for other_idx, other_row in enumerate(other_rel):
+                for idx in index.get(other_row[other_join_col], []):
+                    matches[idx].append(other_idx)
+
+        # Strip the join columns once per row rather than once per pair
+        vals = [[val for idx, val in enumerate(row) if idx != join_col]
+                for row in rel]
+        other_vals = [
+            [val for idx, val in enumerate(row) if idx != other_join_col]
+            for row in other_rel]
+        result = []
+        for idx, row in enumerate(rel):
+            key, row_vals = row[join_col], vals[idx]
+            for other_idx in matches[idx]:
+                result.append([key] + row_vals + other_vals[other_idx])
         return result
 
     @magic
-    def join(self, rel, other_rel, join_col, other_join_col, is_key_priv):
-        d = DeferredList([rel.another(), other_rel.another()])
+    def join(self, rel, other_rel, join_col, other_join_col, is_key_priv,
+             is_key_unique=False, compact=True):
+        # is_key_unique selects the sort-based join for private keys,
+        # which is only correct if the join keys of rel are unique
+        # (e.g., a primary key joined with a foreign key)
+        inputs = self._private_input if is_key_priv else self._compacted
+        d = DeferredList([inputs(rel), inputs(other_rel)])
+        d.addCallback(self._handed_on)
         if is_key_priv:
-            return self.rt.schedule_callback(d, self._join, join_col, 
-                other_join_col)
+            return schedule_forked(self.rt, d, self._join, join_col,
+                other_join_col, is_key_unique=is_key_unique, compact=compact)
         else:
-            return self.rt.schedule_callback(d, self._open_join, join_col,
+            return schedule_forked(self.rt, d, self._open_join, join_col,
                 other_join_col)
 
     @cutofftail
-    def _aggregate_sum(self, rel, key_col, agg_col):
-
-        # Note: the indicator value of the last element will
-        # *always* be 1
-        def cond_sum(e1, e2, key, val, ind):
-            comp = e1[key] == e2[key]
-            val1_copy = e1[val] 
-            e1[val] = (1 - comp) * e1[val]
-            e1[ind] = (1 - comp) # set indicator
-            e2[val] = comp * val1_copy + e2[val]
-            return e1, e2
-
-        def tail_len_received(tail_len, rel, aggregated):
-            without_indicator = [row[:-1] for row in rel]
-            rt.handle_deferred_data(aggregated, 
-                without_indicator[0:len(rel) - int(tail_len)])
+    def _aggregate_sum(self, rel, key_col, agg_col, presorted=False,
+                       key_widths=None):
 
-        rel = [[row[key_col], row[agg_col]] for row in rel]
-        sorted_by_key = sort(rel, lambda x: x[0])
-        result = [row + [1] for row in sorted_by_key]
+        # Segmented sum: each element is a pair (c, v) where c is 1 iff
+        # the row belongs to the same group as the row before it
+        def seg_sum(e1, e2):
+            c1, v1 = e1
+            c2, v2 = e2
+            return c1 * c2, v2 + c2 * v1
 
-        for i in range(len(result) - 1):
-            result[i], result[i + 1] = cond_sum(
-                result[i], result[i + 1], 0, 1, 2)
+        # For padded input, also a segmented or of the indicators (p), as
+        # a group is only present if one of its rows is
+        def seg_sum_any(e1, e2):
+            c1, v1, p1 = e1
+            c2, v2, p2 = e2
+            return c1 * c2, v2 + c2 * v1, p2 + c2 * (p1 - p1 * p2)
 
-        return result
+        key_cols = key_col if isinstance(key_col, (list, tuple)) else [key_col]
+        num_keys = len(key_cols)
+        rel, ind = self._indicators(rel)
+        if ind is None:
+            rel = [[row[col] for col in key_cols] + [row[agg_col]]
+                   for row in rel]
+        else:
+            rel = [[row[col] for col in key_cols] + [row[agg_col] * present,
+                   present] for row, present in zip(rel, ind)]
+        if num_keys == 1:
+            key = lambda row: row[0]
+        elif key_widths and sum(key_widths) <= self.rt.options.bit_length:
+            # A composite key packed into a single value costs one
+            # comparison and one equality test, like a single key
+            rel = [[pack(row[:num_keys], key_widths)] + row for row in rel]
+            key = lambda row: row[0]
+        else:
+            key = lambda row: row[:num_keys]
+
+        def group_sums(sorted_by_key):
+            keys = [key(row) for row in sorted_by_key]
+            # All equality tests between adjacent keys can run in parallel.
+            # They are not run on bit decompositions of the sorted keys:
+            # a decomposition takes l + kappa random bits, an opening each,
+            # and about 5l multiplications, while every key takes part in
+            # at most two tests.
+            same = [equals(keys[i], keys[i + 1])
+                    for i in range(len(keys) - 1)]
+            # Only the last row of a group keeps the group's sum and has
+            # its indicator set. Note: the indicator value of the last
+            # element will *always* be 1
+            ends = [1 - flag for flag in same] + [1]
+            if ind is None:
+                sums = prefix_scan(zip([0] + same,
+                    [row[-1] for row in sorted_by_key]), seg_sum)
+                return [row[-num_keys - 1:-1] + [end * running, end]
+                        for row, (_, running), end
+                        in zip(sorted_by_key, sums, ends)]
+            sums = prefix_scan(zip([0] + same,
+                [row[-2] for row in sorted_by_key],
+                [row[-1] for row in sorted_by_key]), seg_sum_any)
+            return [row[-num_keys - 2:-2] + [end * running, end * present]
+                    for row, (_, running, present), end
+                    in zip(sorted_by_key, sums, ends)]
 
-    def _flatten_dict(self, d):
-        flattened = []
-        for k, v in d.items():
-            if isinstance(v, dict):
-                flattened = flattened + [[k] + f for f in self._flatten_dict(v)]
+        if presorted:
+            return group_sums(rel)
+        return self._then(sort(rel, key, scheduler=self.scheduler),
+                          group_sums)
+
+    def _open_aggregate(self, rel, key_cols, aggs):
+        # Groups are kept in order of first appearance
+        ops = []
+        for op, col in aggs:
+            if op == 'mean':
+                ops.extend([('sum', col), ('count', col)])
+            elif op in AGGREGATES:
+                ops.append((op, col))
             else:
-                flattened.append([k, v])
-        return flattened
-    
-    def _open_aggregate(self, rel, key_cols, agg_col, op):
-        dict_result = {}
+                raise ValueError("Unknown aggregate: %s" % op)
+        groups, order = {}, []
         for row in rel:
-            current_dict = dict_result
-            for key_col in key_cols[:-1]:
-                key_val = row[key_col]
-                if key_val not in current_dict:
-                    current_dict[key_val] = {}
-                current_dict = current_dict[key_val]
-            key_col = key_cols[-1]
-            key_val = row[key_col]
-            if key_val not in current_dict:
-                current_dict[key_val] = row[agg_col]
+            key = tuple([row[key_col] for key_col in key_cols])
+            accs = groups.get(key)
+            if accs is None:
+                groups[key] = [AGGREGATES[op][0](row[col]) for op, col in ops]
+                order.append(key)
             else:
-                current_dict[key_val] = op(current_dict[key_val], row[agg_col])
-        return self._flatten_dict(dict_result)    
+                for idx, (op, col) in enumerate(ops):
+                    accs[idx] = AGGREGATES[op][1](accs[idx], row[col])
+        return [list(key) + groups[key] for key in order]
 
     @magic
-    def aggregate_sum(self, rel, key_col, agg_col, is_key_priv):
+    def aggregate_sum(self, rel, key_col, agg_col, is_key_priv,
+                      presorted=False, compact=True, key_widths=None):
+        # key_col may be a list of columns. For private keys, key_widths
+        # gives their public bit widths; if these add up to at most the
+        # bit length for comparisons, the columns are packed into one
+        # key, otherwise they are compared lexicographically. presorted
+        # skips sorting for private keys if rel is already sorted on
+        # key_col.
+        key_cols = key_col if isinstance(key_col, (list, tuple)) else [key_col]
         if is_key_priv:
-            return self.rt.schedule_callback(
-                rel.another(), self._aggregate_sum, key_col, agg_col)
+            return schedule_forked(self.rt,
+                self._private_input(rel), self._aggregate_sum, key_col, agg_col,
+                presorted=presorted, compact=compact, key_widths=key_widths)
         else:
-            return self.rt.schedule_callback(
-                rel.another(), 
-                self._open_aggregate, 
-                [key_col], 
-                agg_col, 
-                lambda x, y: x + y
+            return schedule_forked(self.rt,
+                self._compacted(rel),
+                self._open_aggregate,
+                key_cols,
+                [('sum', agg_col)]
             )
 
+    @magic
+    def aggregate(self, rel, key_cols, aggs):
+        # Groups rel by the public key_cols and computes all aggs, given as
+        # (op, col) pairs with op one of sum, count, min, max and mean, in
+        # a single pass. Output rows hold the key values followed by one
+        # column per aggregate, or two for mean: its sum and count.
+        return schedule_forked(self.rt, self._compacted(rel),
+            self._open_aggregate, key_cols, aggs)
+
     def _project(self, rel, comp):
-        return [comp(*row) for row in rel]
+        if isinstance(rel, ChunkedRel):
+            return self._per_chunk(rel, self._project, comp)
+        projected = [comp(*row) for row in rel]
+        if isinstance(rel, IndicatorRel):
+            return IndicatorRel(projected, rel.ind)
+        return projected
 
     @magic        
     def project(self, rel, comp):
-        return self.rt.schedule_callback(rel.another(), self._project, comp)
+        return schedule_forked(self.rt, rel.another(), self._project, comp)
         
+    def _select(self, rel, cond, cols):
+        if cond is None:
+            return rel
+        if isinstance(rel, ChunkedRel):
+            selected = self._per_chunk(rel, self._select, cond, cols)
+            selected.padded = True
+            return selected
+        if cols is None:
+            flags = [cond(*row) for row in rel]
+        else:
+            flags = [cond(*[row[col] for col in cols]) for row in rel]
+        if isinstance(rel, IndicatorRel):
+            flags = [flag * ind for flag, ind in zip(flags, rel.ind)]
+        if all(isinstance(flag, (int, long)) for flag in flags):
+            # Public predicate, nothing to hide
+            return [row for row, flag in zip(rel, flags) if flag]
+        # Keep the flags as indicators; the rows are only dropped at the
+        # next operator that needs a compact relation
+        return IndicatorRel(rel, flags)
+
+    def _divide(self, rel, num_col, den_col, l, method):
+        if isinstance(rel, ChunkedRel):
+            return self._per_chunk(rel, self._divide, num_col, den_col,
+                                   l, method)
+        xs = [row[num_col] for row in rel]
+        ys = [row[den_col] for row in rel]
+        if method == 'bitwise':
+            quotients = divide_column(xs, ys, l)
+        elif method == 'newton':
+            quotients = divide_newton(xs, ys, l)
+        else:
+            raise ValueError("Unknown divide method: %s" % method)
+        divided = [list(row[:num_col]) + [quotient] + list(row[num_col + 1:])
+                   for row, quotient in zip(rel, quotients)]
+        if isinstance(rel, IndicatorRel):
+            return IndicatorRel(divided, rel.ind)
+        return divided
+
+    @magic
+    def divide(self, rel, num_col, den_col, l=12, method='bitwise'):
+        # Replaces column num_col by its quotient with column den_col. With
+        # method bitwise, see divide_column for the precondition, with
+        # method newton see divide_newton.
+        return schedule_forked(self.rt, rel.another(), self._divide,
+            num_col, den_col, l, method)
+
+    def _topk(self, rel, key_col, k, ascending):
+        return topk(rel, lambda row: row[key_col], k, ascending,
+                    scheduler=self.scheduler)
+
+    @magic
+    def topk(self, rel, key_col, k, ascending=False):
+        # The k rows with the largest values in column key_col, largest
+        # first, or the k smallest if ascending, like a sort followed by
+        # a limit but at a fraction of its cost for small k
+        return schedule_forked(self.rt, self._compacted(rel), self._topk,
+            key_col, k, ascending)
+
     @magic
-    def select(self, rel, cond):
-        # TODO: implement
-        return rel.another()
+    def select(self, rel, cond, cols=None):
+        # If cols is given, cond only gets the values of these columns,
+        # which allows pushing the select below joins
+        return schedule_forked(self.rt,
+            rel.another(), self._select, cond, cols)
         
     def _broadcast(self, parties, field, invalue):
         values = self.rt.shamir_share(parties, field, invalue, 0) # 0 threshold because public
         return gather_shares([self.rt.open(value) for value in values])
         
-    def _scatter(self, rel, field, thresholds):
+    def _share_chunk(self, inputter, field, values, count, threshold):
+        # Shares count values from inputter, sending a single message to
+        # every other player, so count must not exceed OPEN_BATCH. Returns
+        # a Deferred with the Shares.
+        rt = self.rt
+        rt.program_counter[-1] += 1
+        pc = tuple(rt.program_counter)
+        if rt.id != inputter:
+            received = Deferred()
+            rt._expect_data(inputter, SHARE, received)
+            return rt.schedule_callback(received, lambda data:
+                [Share(rt, field, field(long(share, 16)))
+                 for share in data.split()])
+        shares = [shamir.share(field(value), threshold, rt.num_players)
+                  for value in values]
+        for peer_id in rt.players:
+            if peer_id != rt.id:
+                rt.protocols[peer_id].sendData(pc, SHARE, ' '.join(
+                    ['%x' % player_shares[peer_id - 1][1].value
+                     for player_shares in shares]))
+        rt.activate_reactor()
+        return succeed([Share(rt, field, player_shares[rt.id - 1][1])
+                        for player_shares in shares])
+
+    def _share_chunks(self, player, field, rel, size, numcols, thresholds,
+                      chunk_size):
+
+        def to_rows(columns):
+            return [list(row) for row in zip(*[col for _, col in columns])]
+
+        def share_column(values, count, threshold):
+            # In messages of at most OPEN_BATCH values
+            batches = [self._share_chunk(player, field,
+                values[start:start + OPEN_BATCH],
+                min(OPEN_BATCH, count - start), threshold)
+                for start in range(0, count, OPEN_BATCH)]
+            return self.rt.schedule_callback(DeferredList(batches),
+                lambda batches: [share for _, batch in batches
+                                 for share in batch])
+
+        def share_rows(start):
+            count = min(chunk_size, size - start)
+            # Sliced once per chunk and in order, so rel may be a stream
+            rows = rel[start:start + count]
+            columns = [share_column([row[col] for row in rows], count,
+                                    thresholds[col])
+                       for col in range(numcols)]
+            return self.rt.schedule_callback(DeferredList(columns), to_rows)
+
+        starts = range(0, size, chunk_size)
+        if self.scheduler is not None:
+            # Every chunk is a batch, so that a chunk is only read and
+            # shared once the chunks window batches before it are in
+            stream = self.scheduler.stream()
+            return [stream.submit(share_rows, start) for start in starts]
+        return [share_rows(start) for start in starts]
+
+    @magic
+    def shared(self, rel):
+        # Starts a pipeline from a relation that is already secret shared,
+        # e.g., the output of another runtime
+        return succeed(rel)
+
+    def _preaggregate(self, rel, key_col, agg_col):
+        # Sums agg_col over the rows that share a key, in the clear. The
+        # other columns of a group are those of its first row.
+        key_cols = key_col if isinstance(key_col, (list, tuple)) else [key_col]
+        groups, order = {}, []
+        for row in rel:
+            key = tuple([row[col] for col in key_cols])
+            if key in groups:
+                groups[key][agg_col] += row[agg_col]
+            else:
+                groups[key] = list(row)
+                order.append(key)
+        return [groups[key] for key in order]
+
+    def _scatter(self, rel, field, thresholds, chunk_size=None, preagg=None):
+        if preagg is not None:
+            rel = self._preaggregate(rel, *preagg)
+
         def dimsreceived(dims, rel, shared_rel, thresholds):
             # TODO: add sanity checks here
             sizes = [int(size) for size in dims[0][1]]
             numcols = max([int(col) for col in dims[1][1]])
+            if chunk_size:
+                chunks = []
+                for player in self.rt.players:
+                    chunks.extend(self._share_chunks(player, field,
+                        rel if self.rt.id == player else [],
+                        sizes[player - 1], numcols, thresholds, chunk_size))
+                self.rt.handle_deferred_data(shared_rel, ChunkedRel(chunks))
+                return
             combined_rel = []
             for player in self.rt.players:
                 if self.rt.id == player:
@@ -314,53 +1313,152 @@ class Rel:
         numcols = self._broadcast(self.rt.players, field, subnumcols)
         dl = DeferredList([sizes, numcols])
         shared_rel = Deferred()
-        self.rt.schedule_callback(dl, dimsreceived, rel, shared_rel, thresholds) 
+        schedule_forked(self.rt, dl, dimsreceived, rel, shared_rel, thresholds)
         return shared_rel
         
     @magic
-    def scatter(self, rel, field, thresholds):
-        return self._scatter(rel, field, thresholds)
+    def scatter(self, rel, field, thresholds, chunk_size=None, preagg=None):
+        # With chunk_size, every player shares its rows chunk by chunk,
+        # one message per column and chunk, and the result is a
+        # ChunkedRel that later operators can start on right away.
+        #
+        # preagg = (key_col, agg_col) makes every player sum its own rows
+        # per key before sharing them, for a downstream aggregate_sum on
+        # the same columns. This reveals the number of distinct keys of
+        # every player, so it is off by default.
+        return self._scatter(rel, field, thresholds, chunk_size, preagg)
         
-    def _gather(self, rel, cols_to_gather, recps):
+    def _open_chunk(self, values, recps):
+        # Opens values to recps. Every player sends its shares in a single
+        # message to every recipient, so count should not exceed about
+        # 3000. Returns a Deferred with the opened values for recipients
+        # and None for everyone else.
+        rt = self.rt
+        rt.program_counter[-1] += 1
+        pc = tuple(rt.program_counter)
+        field = values[0].field
 
-        def all_gathered(rawrel, d, final_rel):
-            # TODO: this is sloppy
-            for row_idx, row in enumerate(final_rel):
-                final_rel[row_idx] = tuple([int(rawrel.pop(0)) if not value else value for value in row])
-            self.rt.handle_deferred_data(d, final_rel)
-    
-        final_rel = []
-        to_wait_on = []
-        for row in rel:
-            final_rel.append([None for _ in range(len(row))])
-            for index, value in enumerate(row):
-                if index not in cols_to_gather:
-                    final_rel[-1][index] = value
-                else:
-                    opened = self.rt.output(value, recps)
-                    if opened:
-                        to_wait_on.append(opened)
+        def send(shares):
+            data = ' '.join(['%x' % share.value for share in shares])
+            for peer_id in recps:
+                if peer_id != rt.id:
+                    rt.protocols[peer_id].sendData(pc, SHARE, data)
+            rt.activate_reactor()
+            return shares
 
-        if to_wait_on:
-            dl = gather_shares(to_wait_on)
+        own = rt.schedule_callback(gather_shares(values), send)
+        if rt.id not in recps:
+            return None
+        peers = [peer_id for peer_id in sorted(rt.players) if peer_id != rt.id]
+        received = [own]
+        for peer_id in peers:
             d = Deferred()
-            self.rt.schedule_callback(dl, all_gathered, d, final_rel)
-            return d
-        else:
+            rt._expect_data(peer_id, SHARE, d)
+            received.append(rt.schedule_callback(d, lambda data:
+                [field(long(share, 16)) for share in data.split()]))
+
+        def recombine(results):
+            ids = [field(player_id) for player_id in [rt.id] + peers]
+            shares = [column for _, column in results][:rt.threshold + 1]
+            return [shamir.recombine(zip(ids, [column[idx] for column in shares]))
+                    for idx in range(len(values))]
+
+        return rt.schedule_callback(DeferredList(received), recombine)
+
+    def _gather_rows(self, rel, cols_to_gather, recps):
+        # Opens the shares in the columns cols_to_gather, in batches of
+        # OPEN_BATCH values, and puts them back in place
+        cols = set(cols_to_gather)
+        to_open = [value for row in rel for idx, value in enumerate(row)
+                   if idx in cols and isinstance(value, Share)]
+
+        def all_gathered(batches):
+            opened = iter([value for _, batch in batches for value in batch])
+            return [tuple([int(opened.next())
+                           if idx in cols and isinstance(value, Share)
+                           else value for idx, value in enumerate(row)])
+                    for row in rel]
+
+        batches = [self._open_chunk(to_open[start:start + OPEN_BATCH], recps)
+                   for start in range(0, len(to_open), OPEN_BATCH)]
+        if self.rt.id not in recps:
             return None
+        return schedule_forked(self.rt, DeferredList(batches), all_gathered)
+
+    def _gather(self, rel, cols_to_gather, recps, chunk_size=None):
+        # Recipients get the rows with the gathered columns opened, all
+        # other players get None. A chunked relation is opened chunk by
+        # chunk, as is any relation if chunk_size is given.
+        if isinstance(rel, ChunkedRel) and not rel.padded:
+            return self._per_chunk(rel, self._gather, cols_to_gather, recps)
+        rel = self._materialize(rel)
+        if isinstance(rel, Deferred):
+            return schedule_forked(self.rt, rel, self._gather,
+                cols_to_gather, recps, chunk_size)
+        if chunk_size:
+            chunks = [self._gather_rows(rel[start:start + chunk_size],
+                                        cols_to_gather, recps)
+                      for start in range(0, max(len(rel), 1), chunk_size)]
+            return ChunkedRel([chunk if isinstance(chunk, Deferred)
+                               else succeed(chunk) for chunk in chunks])
+        return self._gather_rows(rel, cols_to_gather, recps)
 
     @magic
-    def gather(self, rel, cols_to_gather, recps):
-        return self.rt.schedule_callback(rel.another(), self._gather, cols_to_gather, recps)
-        
+    def gather(self, rel, cols_to_gather, recps, chunk_size=None):
+        return schedule_forked(self.rt, rel.another(), self._gather,
+            cols_to_gather, recps, chunk_size)
+
+    def _outputwith(self, rel, f):
+        # Calls f once per chunk of a chunked relation, as chunks arrive
+        if isinstance(rel, ChunkedRel) and not rel.padded:
+            return DeferredList([schedule_forked(
+                self.rt, self._fork(chunk), self._outputwith, f)
+                for chunk in rel.chunks])
+        rel = self._materialize(rel)
+        if isinstance(rel, Deferred):
+            return schedule_forked(self.rt, rel, f)
+        return f(rel)
+
     @magic
     def outputwith(self, rel, f):
-        return self.rt.schedule_callback(rel.another(), f)
+        return schedule_forked(self.rt, rel.another(), self._outputwith, f)
+
+    def _optimize(self):
+        if not self.optimized:
+            optimize(self.plan, self.defer_compaction)
+            self.optimized = True
+
+    def explain(self, num_rows=1000):
+        """Returns the optimized plan with estimated costs, assuming that
+           every scatter receives *num_rows* rows in total.
+           """
+        self._optimize()
+        return explain(self.plan, num_rows)
+
+    def estimate(self, num_rows=1000):
+        """Returns the estimated total costs of the optimized plan by name,
+           assuming that every scatter receives *num_rows* rows in total.
+           """
+        self._optimize()
+        return totals(self.plan, num_rows)
 
     def finish(self):
-        all_defs = []
+        self._optimize()
+        for idx, node in enumerate(self.plan):
+            # Operators run in callbacks, so each of them needs a program
+            # counter of its own, see schedule_forked
+            self.rt.program_counter[-1] += 1
+            node.md = MagicDeferred(
+                labelled('%d:%s' % (idx, node.op),
+                         lambda: node.f(self, **node.params)),
+                self.keep_results)
+            self.rt.program_counter[-1] += 1
+            self.mag_defs.append(node.md)
         for md in self.mag_defs:
             md.forward_callbacks(self.rt)
-            all_defs.extend(md.children)
-        dl = DeferredList(all_defs)
+        for md in self.mag_defs:
+            md.release_when_consumed()
+        dl = DeferredList([md.released for md in self.mag_defs])
+        if getattr(self.rt, 'report_path', None) is not None:
+            dl.addCallback(lambda _: self.rt.write_report())
         self.rt.schedule_callback(dl, lambda _: self.rt.shutdown())
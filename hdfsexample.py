@@ -11,40 +11,31 @@ from viff.equality import ProbabilisticEqualityMixin
 from viff.config import load_config
 from viff.util import find_prime
 
-from extensions import Rel, divide
+from extensions import Rel
+from hdfsio import HadoopFS, LocalFS, RowStream, RowWriter, TextFormat
 import copy
 import random
-import subprocess
+import sys
 
-def read_from_hdfs(input_path):
-    input_stream = subprocess.Popen(["hadoop", "fs", "-cat", input_path + "/*"], 
-                                    stdout=subprocess.PIPE).stdout
-    rel = [[int(val) for val in row.split()] for row in input_stream]
-    print "Read in from HDFS: ", rel
-    return rel
+ROOT = "/home/nikolaj/Desktop/work/Musketeer/MUSKETEER_ROOT"
+CHUNK_SIZE = 1000
+# Chunks (and sorting network layers) in flight at a time
+WINDOW = 4
 
-def write_to_hdfs(rel, output_path):
+def protocol(rt, Zp, fs, writers, rows):
     
-    def to_string(row):
-        return ' '.join([str(v) for v in row])
-
-    rel_str = '\n'.join([to_string(row) for row in rel])
-    print "Will write to HDFS: "
-    print rel_str
-
-    return True
-
-def protocol(rt, Zp):
-    
-    ext = Rel(rt)
+    ext = Rel(rt, window=WINDOW)
     
-    selected_input = ext.input(
-        read_from_hdfs("/home/nikolaj/Desktop/work/Musketeer/MUSKETEER_ROOT/selected_input"), 
-        rt.players, Zp
+    # Rows are parsed chunk by chunk as they are shared, at most WINDOW
+    # chunks ahead. Without a row count, the input is read once more
+    # beforehand to count them.
+    selected_input = ext.scatter(
+        RowStream(fs, ROOT + "/selected_input", TextFormat(), count=rows),
+        Zp, [1, 1], chunk_size=CHUNK_SIZE
     )
     
     local_rev = ext.aggregate_sum(
-        selected_input, 0, 1
+        selected_input, 0, 1, True
     )
 
     first_val_blank_math = ext.project(
@@ -54,7 +45,7 @@ def protocol(rt, Zp):
     first_val_blank = ext.select(first_val_blank_math, None)
     
     total_rev = ext.aggregate_sum(
-        first_val_blank, 0, 1
+        first_val_blank, 0, 1, True
     )
     
     scaled_local_rev = ext.project(
@@ -62,12 +53,11 @@ def protocol(rt, Zp):
     )
     
     local_total_rev = ext.join(
-        scaled_local_rev, total_rev, 0, 0
+        scaled_local_rev, total_rev, 0, 0, True
     )
 
-    market_share = ext.project(
-        local_total_rev, 
-        lambda e1, e2, e3: [e1, divide(e2, e3), e3]
+    market_share = ext.divide(
+        local_total_rev, 1, 2
     )
 
     market_share_squared = ext.project(
@@ -75,22 +65,31 @@ def protocol(rt, Zp):
     )
 
     hhi = ext.aggregate_sum(
-        market_share_squared, 0, 1
+        market_share_squared, 0, 1, True
     )
 
-    ext.output(hhi, write_to_hdfs, "path")
+    # Every opened chunk is written out as soon as it is there
+    writer = RowWriter(fs, ROOT + "/hhi-%d" % rt.id, TextFormat())
+    writers.append(writer)
+    ext.outputwith(ext.gather(hhi, [0, 1], sorted(rt.players),
+        chunk_size=CHUNK_SIZE), writer.write)
 
     ext.finish()
 
 def report_error(err):
-    import sys
     sys.stderr.write(str(err))
 
 if __name__ == "__main__":
     parser = OptionParser()
     Runtime.add_options(parser)
+    parser.add_option("--local", metavar="DIR",
+        help="read and write DIR instead of HDFS")
+    parser.add_option("--rows", type="int", metavar="N",
+        help="the number of input rows of this player, if known")
     options, args = parser.parse_args()
     pid, players = load_config(args[0])
+    fs = LocalFS(options.local) if options.local else HadoopFS()
+    writers = []
     Zp = GF(find_prime(2**65, blum=True))
     
     runtime_class = make_runtime_class(
@@ -98,7 +97,9 @@ if __name__ == "__main__":
     )
     pre_runtime = create_runtime(pid, players, 1, options, 
         runtime_class=runtime_class)
-    pre_runtime.addCallback(protocol, Zp)
+    pre_runtime.addCallback(protocol, Zp, fs, writers, options.rows)
     pre_runtime.addErrback(report_error)
 
     reactor.run()
+    for writer in writers:
+        writer.close()
@@ -0,0 +1,301 @@
+from itertools import chain
+import os
+import struct
+import subprocess
+
+# Streaming input and output of integer rows, in HDFS or in a local
+# directory standing in for it, e.g.
+#
+#   rows = RowStream(HadoopFS(), input_path, TextFormat())
+#   ext.scatter(rows, Zp, [1, 1], chunk_size=1000)
+#   ...
+#   out = RowWriter(HadoopFS(), output_path,
+#                   BinaryFormat('varint', modulus=Zp.modulus))
+#   ext.outputwith(ext.gather(rel, cols, recps, chunk_size=1000), out.write)
+#
+# RowStream parses its input block by block, only as far as scatter has
+# consumed it, and RowWriter writes every chunk as gather opens it. Rows
+# are either whitespace separated text, one row per line, or binary: a
+# header line "RIFFROW1 <encoding> <numcols>" followed by the values of
+# every row as big-endian int64s or as zigzag varints.
+
+BLOCK = 1 << 16
+MAGIC = 'RIFFROW1'
+
+class LocalFS:
+    """Stands in for HDFS with the directory *root*. A path is read from
+       all files in it (or from the file itself), in name order and
+       skipping files such as _SUCCESS, like ``hadoop fs -cat path/*``.
+       """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _full(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def open_read(self, path):
+        full = self._full(path)
+        if not os.path.isdir(full):
+            return open(full, 'rb')
+        return Concat([os.path.join(full, name)
+                       for name in sorted(os.listdir(full))
+                       if not name.startswith(('.', '_'))])
+
+    def open_write(self, path):
+        full = self._full(path)
+        if os.path.dirname(full) and not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        return open(full, 'wb')
+
+class HadoopFS:
+    """Reads and writes HDFS through the hadoop command line client."""
+
+    def open_read(self, path):
+        return subprocess.Popen(['hadoop', 'fs', '-cat', path + '/*'],
+                                stdout=subprocess.PIPE).stdout
+
+    def open_write(self, path):
+        return HadoopWriter(subprocess.Popen(
+            ['hadoop', 'fs', '-put', '-', path], stdin=subprocess.PIPE))
+
+class HadoopWriter:
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def flush(self):
+        self.proc.stdin.flush()
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise IOError("hadoop fs -put exited with status %d"
+                          % self.proc.returncode)
+
+class Concat:
+    # Reads several files one after the other, opening each in turn
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.current = None
+
+    def read(self, size):
+        while self.paths or self.current:
+            if self.current is None:
+                self.current = open(self.paths.pop(0), 'rb')
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+        return ''
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+def blocks(stream):
+    while True:
+        block = stream.read(BLOCK)
+        if not block:
+            stream.close()
+            return
+        yield block
+
+class TextFormat:
+
+    def rows(self, blocks):
+        rest = ''
+        for block in blocks:
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield [int(val) for val in line.split()]
+        if rest.strip():
+            yield [int(val) for val in rest.split()]
+
+    def dump(self, rows):
+        return ''.join([' '.join([str(val) for val in row]) + '\n'
+                        for row in rows])
+
+def zigzag(val):
+    return val << 1 if val >= 0 else ((-val) << 1) - 1
+
+def unzigzag(val):
+    return val >> 1 if not val & 1 else -((val + 1) >> 1)
+
+def encode_varint(val):
+    val, out = zigzag(val), []
+    while val >= 0x80:
+        out.append(chr(val & 0x7f | 0x80))
+        val >>= 7
+    out.append(chr(val))
+    return ''.join(out)
+
+class BinaryFormat:
+    """Rows of *numcols* values, as int64s or as varints. When reading,
+       both are taken from the header.
+
+       With *modulus*, values are elements of the field with that
+       modulus, such as the output of gather. They are written as the
+       signed values they stand for, e.g., modulus - 1 as -1, and read
+       back into ``[0, modulus)``. Values that still do not fit in an
+       int64 need varints.
+       """
+
+    def __init__(self, encoding='int64', numcols=None, modulus=None):
+        if encoding not in ('int64', 'varint'):
+            raise ValueError("Unknown encoding %s" % encoding)
+        self.encoding = encoding
+        self.numcols = numcols
+        self.modulus = modulus
+        self.header_written = False
+
+    def rows(self, blocks):
+        blocks = iter(blocks)
+        data = ''
+        for block in blocks:
+            data += block
+            if '\n' in data:
+                break
+        header, _, data = data.partition('\n')
+        fields = header.split()
+        if len(fields) != 3 or fields[0] != MAGIC:
+            raise ValueError("Not a binary row file")
+        self.encoding, self.numcols = fields[1], int(fields[2])
+        parse = self._int64s if self.encoding == 'int64' else self._varints
+        row = []
+        for val in parse(data, blocks):
+            row.append(val % self.modulus if self.modulus else val)
+            if len(row) == self.numcols:
+                yield row
+                row = []
+        if row:
+            raise ValueError("Truncated binary row file")
+
+    def _int64s(self, data, blocks):
+        rest = ''
+        for block in chain([data], blocks):
+            block = rest + block
+            usable = len(block) - len(block) % 8
+            for val in struct.unpack('>%dq' % (usable // 8), block[:usable]):
+                yield val
+            rest = block[usable:]
+        if rest:
+            raise ValueError("Truncated binary row file")
+
+    def _varints(self, data, blocks):
+        val = shift = 0
+        for block in chain([data], blocks):
+            for char in block:
+                byte = ord(char)
+                val |= (byte & 0x7f) << shift
+                if byte & 0x80:
+                    shift += 7
+                else:
+                    yield unzigzag(val)
+                    val = shift = 0
+        if shift:
+            raise ValueError("Truncated binary row file")
+
+    def dump(self, rows):
+        out = []
+        if not self.header_written:
+            if self.numcols is None:
+                self.numcols = len(rows[0]) if rows else 0
+            out.append('%s %s %d\n' % (MAGIC, self.encoding, self.numcols))
+            self.header_written = True
+        for row in rows:
+            if self.modulus:
+                row = [val - self.modulus if val > self.modulus // 2 else val
+                       for val in row]
+            if self.encoding == 'int64':
+                try:
+                    out.append(struct.pack('>%dq' % len(row), *row))
+                except struct.error:
+                    raise ValueError("Row %s does not fit in int64s, use "
+                                     "varints" % (row,))
+            else:
+                out.extend([encode_varint(val) for val in row])
+        return ''.join(out)
+
+class RowStream:
+    """The rows at *path*, parsed chunk by chunk as they are read, which
+       must be in order, as scatter does. Its length takes a pass of its
+       own over the input unless *count* is given.
+       """
+
+    def __init__(self, fs, path, fmt, count=None):
+        self.fs = fs
+        self.path = path
+        self.fmt = fmt
+        self.count = count
+        self.rows = None
+        self.ahead = []
+        self.pos = 0
+
+    def __len__(self):
+        if self.count is None:
+            self.count = 0
+            for _ in self.fmt.rows(blocks(self.fs.open_read(self.path))):
+                self.count += 1
+        return self.count
+
+    def _take(self, num):
+        if self.rows is None:
+            self.rows = self.fmt.rows(blocks(self.fs.open_read(self.path)))
+        taken, self.ahead = self.ahead[:num], self.ahead[num:]
+        for row in self.rows:
+            if len(taken) == num:
+                self.ahead.append(row)
+                break
+            taken.append(row)
+        return taken
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            if (idx.start or 0) != self.pos or idx.step not in (None, 1):
+                raise IndexError("RowStream can only be read in order")
+            rows = self._take(idx.stop - self.pos)
+            self.pos += len(rows)
+            return rows
+        if idx != self.pos:
+            raise IndexError("RowStream can only be read in order")
+        rows = self._take(1)
+        if not rows:
+            raise IndexError("RowStream index out of range")
+        self.ahead = rows + self.ahead
+        return rows[0]
+
+    def __iter__(self):
+        while True:
+            rows = self[self.pos:self.pos + BLOCK]
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+class RowWriter:
+    """Writes rows to *path* as they come, e.g. every chunk opened by
+       gather. Must be closed once the last rows are written.
+       """
+
+    def __init__(self, fs, path, fmt):
+        self.out = fs.open_write(path)
+        self.fmt = fmt
+
+    def write(self, rows):
+        # Players that are not recipients of a gather get None
+        if rows is None:
+            return
+        self.out.write(self.fmt.dump(rows))
+        self.out.flush()
+
+    def close(self):
+        self.out.write(self.fmt.dump([]))
+        self.out.close()
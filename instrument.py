@@ -0,0 +1,219 @@
+from viff.runtime import Share
+import json
+import time
+
+# Per-operator costs. Every Rel operator runs under a label such as
+# "3:join", and primitives within it extend the label, e.g.
+# "3:join/sort". Like the program counter, the label is saved by
+# schedule_callback and restored when the callback runs, so that work
+# done in callbacks is attributed to the operator that scheduled it.
+#
+# With InstrumentMixin, rt.instrument(path) makes Rel.finish() write a JSON
+# report with, per label, the multiplications, comparisons, equality tests,
+# openings, messages and bytes sent, rounds and time. As in sim.py, rounds
+# are the depth of the interactive operations, counting each
+# multiplication, comparison, equality test and opening as one round. Every
+# Share records its depth, and an operator takes as many rounds as lie
+# between the deepest result and the shallowest operand of its operations.
+# The operations a comparison or equality test is made of, including those
+# in its callbacks, count towards its costs but not its depth.
+#
+# InstrumentMixin overrides methods of PassiveRuntime, so it must come
+# before it in the method resolution order, see preprocessing.py.
+# With trace_path, every callback is also written as a trace event, which
+# chrome://tracing, Perfetto or speedscope show as a flame chart.
+
+current = ['']
+
+# Whether the current operations are part of a comparison or equality test
+within = [False]
+
+COUNTS = ['multiplications', 'comparisons', 'equality tests', 'openings',
+          'messages', 'bytes sent']
+
+def labelled(name, call):
+    # Calls call() with name appended to the current label
+    outer = current[0]
+    current[0] = outer + '/' + name if outer else name
+    try:
+        return call()
+    finally:
+        current[0] = outer
+
+def operation(name):
+    """Decorator running a primitive under its own label."""
+
+    def decorator(f):
+
+        def wrapper(*args, **kwargs):
+            return labelled(name, lambda: f(*args, **kwargs))
+
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+
+    return decorator
+
+class InstrumentMixin(object):
+    """Counts costs per label while instrumenting, see :meth:`instrument`.
+       """
+
+    report_path = None
+    trace_path = None
+
+    def instrument(self, report_path, trace_path=None):
+        self.report_path = report_path
+        self.trace_path = trace_path
+        self.costs = {}
+        self.events = []
+        self.nested = []
+        self.started = time.time()
+        for peer, protocol in self.protocols.items():
+            protocol.sendData = self._counting(protocol.sendData)
+
+    def _costs(self):
+        label = current[0] or 'other'
+        if label not in self.costs:
+            self.costs[label] = dict([(name, 0) for name in COUNTS],
+                                     low=None, high=0, seconds=0.0,
+                                     first=None, last=None)
+        return self.costs[label]
+
+    def _count(self, name, count=1):
+        if self.report_path is not None:
+            self._costs()[name] += count
+
+    def _counting(self, send):
+
+        def counting_send(program_counter, data_type, data):
+            if self.report_path is not None:
+                costs = self._costs()
+                costs['messages'] += 1
+                costs['bytes sent'] += len(str(data))
+            return send(program_counter, data_type, data)
+
+        return counting_send
+
+    def schedule_callback(self, deferred, func, *args, **kwargs):
+        if self.report_path is None:
+            return super(InstrumentMixin, self).schedule_callback(
+                deferred, func, *args, **kwargs)
+        label, inner = current[0], within[0]
+
+        def timed(*args, **kwargs):
+            outer, outer_inner = current[0], within[0]
+            current[0], within[0] = label, inner
+            self.nested.append(0.0)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.time()
+                own = end - start - self.nested.pop()
+                if self.nested:
+                    self.nested[-1] += end - start
+                costs = self._costs()
+                costs['seconds'] += own
+                costs['first'] = min(costs['first'] or start, start)
+                costs['last'] = max(costs['last'], end)
+                if self.trace_path is not None:
+                    self.events.append((label or 'other', start, end))
+                current[0], within[0] = outer, outer_inner
+
+        return super(InstrumentMixin, self).schedule_callback(
+            deferred, timed, *args, **kwargs)
+
+    def _linear(self, result, operands):
+        # The result of a local operation is as deep as its operands
+        if self.report_path is not None and isinstance(result, Share):
+            result.round = max([getattr(operand, 'round', 0)
+                                for operand in operands])
+        return result
+
+    def _round(self, result, operands):
+        # The result of an interactive operation is one round deeper than
+        # its operands
+        if self.report_path is None or within[0] or result is None:
+            return result
+        low = max([getattr(operand, 'round', 0) for operand in operands])
+        result.round = low + 1
+        costs = self._costs()
+        costs['low'] = min(costs['low'], low) if costs['low'] is not None \
+            else low
+        costs['high'] = max(costs['high'], low + 1)
+        return result
+
+    def _composite(self, call):
+        # Runs a comparison or equality test, and the callbacks it
+        # schedules, without tracking the depth of its own operations
+        outer = within[0]
+        within[0] = True
+        try:
+            return call()
+        finally:
+            within[0] = outer
+
+    def add(self, share_a, share_b):
+        return self._linear(super(InstrumentMixin, self).add(
+            share_a, share_b), [share_a, share_b])
+
+    def sub(self, share_a, share_b):
+        return self._linear(super(InstrumentMixin, self).sub(
+            share_a, share_b), [share_a, share_b])
+
+    def mul(self, share_a, share_b):
+        if not isinstance(share_a, Share) or not isinstance(share_b, Share):
+            return self._linear(super(InstrumentMixin, self).mul(
+                share_a, share_b), [share_a, share_b])
+        self._count('multiplications')
+        return self._round(super(InstrumentMixin, self).mul(
+            share_a, share_b), [share_a, share_b])
+
+    def greater_than_equal(self, share_a, share_b):
+        self._count('comparisons')
+        return self._round(self._composite(
+            lambda: super(InstrumentMixin, self).greater_than_equal(
+                share_a, share_b)), [share_a, share_b])
+
+    def equal(self, share_a, share_b):
+        self._count('equality tests')
+        return self._round(self._composite(
+            lambda: super(InstrumentMixin, self).equal(share_a, share_b)),
+            [share_a, share_b])
+
+    def open(self, share, receivers=None, threshold=None):
+        self._count('openings')
+        return self._round(super(InstrumentMixin, self).open(
+            share, receivers, threshold), [share])
+
+    def report(self):
+        """Returns the costs per label, and their totals."""
+        operators, total = {}, dict([(name, 0) for name in COUNTS],
+                                    rounds=0, seconds=0.0)
+        for label, costs in self.costs.items():
+            result = dict([(name, costs[name]) for name in COUNTS],
+                          rounds=costs['high'] - (costs['low'] or 0),
+                          seconds=round(costs['seconds'], 6))
+            if costs['first'] is not None:
+                result['wall seconds'] = round(
+                    costs['last'] - costs['first'], 6)
+            operators[label] = result
+            for name in COUNTS + ['seconds']:
+                total[name] += result[name]
+            total['rounds'] = max(total['rounds'], costs['high'])
+        total['wall seconds'] = round(time.time() - self.started, 6)
+        return {'player': self.id, 'operators': operators, 'total': total}
+
+    def write_report(self):
+        out = open(self.report_path, 'w')
+        json.dump(self.report(), out, indent=2, sort_keys=True)
+        out.close()
+        if self.trace_path is not None:
+            # Complete events in the Trace Event Format, in microseconds
+            out = open(self.trace_path, 'w')
+            json.dump({'traceEvents': [
+                {'name': label, 'cat': label.split('/')[0], 'ph': 'X',
+                 'ts': int((start - self.started) * 1e6),
+                 'dur': int((end - start) * 1e6), 'pid': self.id, 'tid': 0}
+                for label, start, end in self.events]}, out)
+            out.close()
@@ -0,0 +1,88 @@
+from optparse import OptionParser
+import viff.reactor
+viff.reactor.install()
+from twisted.internet import reactor
+
+from viff.field import GF
+from viff.runtime import make_runtime_class, create_runtime, Runtime
+from viff.comparison import ComparisonToft07Mixin
+from viff.equality import ProbabilisticEqualityMixin
+from viff.config import load_config
+from viff.util import find_prime
+
+from extensions import Rel
+from partition import worker_configs, shard, spawn_workers, wait, save_rel, load_rel
+import random
+import sys
+import time
+
+# Public-key join over k workers per player, e.g.
+#
+#   python joinpartitioned.py player-1.ini 10000 4 --no-ssl
+#
+# Both inputs are sharded by key, so that matching rows of all players
+# meet in the same worker, which joins them and projects the result. The
+# coordinator only has to concatenate the parts.
+
+def inputgen(pid, num_tups, seed):
+    # Seeded, so that all workers of a player see the same input
+    rand = random.Random((pid, seed))
+    return [(rand.randint(0, num_tups), 1) for _ in range(num_tups)] if pid == 1 else []
+
+def output(rel, started):
+    print "Result: %d rows in %.3fs" % (len(rel), time.time() - started)
+
+def result_path(config, worker):
+    return '%s.worker%d.out' % (config, worker)
+
+def worker(rt, Zp, num_tups, k, w, path):
+    ext = Rel(rt)
+    rels = []
+    for seed in range(2):
+        rows = shard(inputgen(rt.id, num_tups, seed), k, key_col=0)[w]
+        selected_input = ext.scatter(rows, Zp, [0, 1])
+        rels.append(ext.gather(selected_input, [0], rt.players.keys()))
+    joined = ext.join(rels[0], rels[1], 0, 0, False)
+    products = ext.project(joined, lambda e1, e2, e3: [e1, e2 * e3])
+    ext.outputwith(products, lambda rel: save_rel(rel, path))
+    ext.finish()
+
+def coordinator(rt, Zp, paths, started):
+    ext = Rel(rt)
+    parts = ext.shared([row for path in paths for row in load_rel(rt, Zp, path)])
+    gathered = ext.gather(parts, [1], rt.players.keys())
+    ext.outputwith(gathered, lambda rel: output(rel, started))
+    ext.finish()
+
+def report_error(err):
+    sys.stderr.write(str(err))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--worker", type="int", default=None,
+        help="run as worker WORKER (set by the coordinator)")
+    Runtime.add_options(parser)
+    options, args = parser.parse_args()
+    num_tups, k = int(args[1]), int(args[2])
+    Zp = GF(find_prime(2**65, blum=True))
+
+    if options.worker is None:
+        started = time.time()
+        configs = worker_configs(args[0], k)
+        wait(spawn_workers(configs))
+        paths = [result_path(config, w) for w, config in enumerate(configs)]
+        start = lambda rt: coordinator(rt, Zp, paths, started)
+    else:
+        path = result_path(args[0], options.worker)
+        start = lambda rt: worker(rt, Zp, num_tups, k, options.worker, path)
+    pid, players = load_config(args[0])
+
+    runtime_class = make_runtime_class(
+        mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
+    )
+    pre_runtime = create_runtime(pid, players, 1, options,
+        runtime_class=runtime_class)
+    pre_runtime.addCallback(start)
+    pre_runtime.addErrback(report_error)
+
+    reactor.run()
@@ -0,0 +1,114 @@
+from viff.libs.configobj import ConfigObj
+from viff.runtime import Share, gather_shares
+from hashlib import sha1
+import subprocess
+import sys
+
+from extensions import merge
+
+# Partitioned execution: every player runs k worker processes, each with
+# its own runtime and its own shard of the input, e.g.
+#
+#   configs = worker_configs(config_path, k)
+#   wait(spawn_workers(configs))
+#
+# Worker w of every player connects to worker w of all other players. The
+# workers write their part of the result with save_rel, and a coordinator
+# runtime on the original config loads and merges the parts with load_rel
+# and Rel.shared.
+
+def derive_keys(section, worker):
+    # Workers must not share PRSS keys, or they would draw the same
+    # randomness for the same program counters
+    for name, val in section.items():
+        if isinstance(val, dict):
+            derive_keys(val, worker)
+        else:
+            digest = sha1('%s:%d' % (val, worker)).hexdigest()
+            section[name] = str(int(digest, 16))
+
+def worker_configs(path, k, port_step=100):
+    """Writes a config for each of *k* workers, derived from the player
+       config at *path*: worker w listens on the original ports plus
+       ``(w + 1) * port_step`` and uses PRSS keys derived from the
+       original ones. Returns the paths of the new configs.
+       """
+    paths = []
+    for worker in range(k):
+        config = ConfigObj(path)
+        for section in config.values():
+            if not isinstance(section, dict):
+                continue
+            if 'port' in section:
+                section['port'] = str(int(section['port'])
+                                      + (worker + 1) * port_step)
+            for name, val in section.items():
+                if name.startswith('prss') and isinstance(val, dict):
+                    derive_keys(val, worker)
+        config.filename = '%s.worker%d' % (path, worker)
+        config.write()
+        paths.append(config.filename)
+    return paths
+
+def shard(rel, k, key_col=None):
+    """Splits *rel* into *k* shards: round robin, or by the hash of the
+       public *key_col* so that all rows with the same key (of all
+       players) end up in the same shard.
+       """
+    shards = [[] for _ in range(k)]
+    for idx, row in enumerate(rel):
+        if key_col is None:
+            shards[idx % k].append(row)
+        else:
+            shards[hash(row[key_col]) % k].append(row)
+    return shards
+
+def spawn_workers(configs, argv=None):
+    # Runs the script in argv (by default this one) once per worker
+    # config, which replaces argv[1], with --worker set to the worker index
+    argv = argv or sys.argv
+    return [subprocess.Popen([sys.executable, argv[0], config] + argv[2:]
+                             + ['--worker', str(worker)])
+            for worker, config in enumerate(configs)]
+
+def wait(procs):
+    for proc in procs:
+        if proc.wait() != 0:
+            raise RuntimeError(
+                "Worker exited with status %d" % proc.returncode)
+
+def save_rel(rel, path):
+    """Writes this player's view of *rel*, public values and own shares,
+       to *path*. Returns a Deferred that fires once it is written.
+       """
+
+    def write(values):
+        values = iter(values)
+        out = open(path, 'w')
+        for row in rel:
+            out.write(' '.join(['s%x' % values.next().value
+                                if isinstance(val, Share) else 'p%d' % val
+                                for val in row]) + '\n')
+        out.close()
+
+    shares = [val for row in rel for val in row if isinstance(val, Share)]
+    d = gather_shares(shares)
+    d.addCallback(write)
+    return d
+
+def load_rel(rt, field, path):
+    # Reads a relation written by save_rel in any runtime of this player
+    rel = []
+    for line in open(path):
+        rel.append([Share(rt, field, field(long(val[1:], 16)))
+                    if val[0] == 's' else int(val[1:])
+                    for val in line.split()])
+    return rel
+
+def merge_sorted(shards, key, ascending=True):
+    # Merges shards that are each sorted by key, pairwise in log k rounds
+    while len(shards) > 1:
+        shards = [merge(shards[i], shards[i + 1], key, ascending)
+                  if i + 1 < len(shards) else shards[i]
+                  for i in range(0, len(shards), 2)]
+    return shards[0] if shards else []
@@ -0,0 +1,244 @@
+from inspect import getcallargs
+from math import ceil, log
+
+# Logical query plans for Rel. Every Rel operator records a PlanNode; the
+# plan is optimized and only then executed, at Rel.finish(). The rewrites
+# only depend on the operators and their public parameters, so all
+# players end up with the same plan.
+
+class PlanNode:
+
+    def __init__(self, f, params):
+        self.f = f
+        self.op = f.__name__
+        self.params = params
+        self.notes = []
+        self.md = None
+        # Whether the node compacts a padded input
+        self.compacts = False
+
+    def inputs(self):
+        return [self.params[name] for name in ('rel', 'other_rel')
+                if isinstance(self.params.get(name), PlanNode)]
+
+    def another(self):
+        return self.md.another()
+
+def make_node(f, rel_self, args, kwargs):
+    params = getcallargs(f, rel_self, *args, **kwargs)
+    del params['self']
+    # Operators only run in Rel.finish(), so their parameters are checked
+    # here, where the caller records them
+    if f.__name__ == 'topk' and params['k'] < 1:
+        raise ValueError("k must be positive")
+    return PlanNode(f, params)
+
+def consumers(plan):
+    result = dict((node, []) for node in plan)
+    for node in plan:
+        for inp in node.inputs():
+            result[inp].append(node)
+    return result
+
+def replace(plan, old, new):
+    for node in plan:
+        for name, val in node.params.items():
+            if val is old:
+                node.params[name] = new
+
+def is_private(node):
+    return node.op in ('join', 'aggregate_sum') and node.params['is_key_priv']
+
+def is_filter(node):
+    return node.op == 'select' and node.params['cond'] is not None
+
+def fuse(comp, other_comp):
+    return lambda *row: other_comp(*comp(*row))
+
+def push_down_selects(plan, defer_compaction=False):
+    # A select on the key column of a join's output filters both inputs
+    # on their join column instead, so that fewer rows are joined. Unless
+    # compaction is deferred, a private join compacts its inputs, which
+    # would reveal the sizes of both filtered inputs rather than only that
+    # of the output, so selects stay above private joins then.
+    for node in plan[:]:
+        join = node.params.get('rel')
+        if not is_filter(node) or not isinstance(join, PlanNode) \
+                or join.op != 'join' or consumers(plan)[join] != [node] \
+                or is_private(join) and not defer_compaction \
+                or node.params['cols'] is None \
+                or any(col != 0 for col in node.params['cols']):
+            continue
+        for rel_name, col_name in [('rel', 'join_col'),
+                                   ('other_rel', 'other_join_col')]:
+            pushed = PlanNode(node.f, dict(node.params,
+                rel=join.params[rel_name],
+                cols=[join.params[col_name]] * len(node.params['cols'])))
+            pushed.notes.append('pushed below join')
+            plan.insert(plan.index(join), pushed)
+            join.params[rel_name] = pushed
+        replace(plan, node, join)
+        plan.remove(node)
+
+def fuse_projects(plan):
+    for node in plan[:]:
+        inp = node.params.get('rel')
+        if node.op != 'project' or not isinstance(inp, PlanNode) \
+                or inp.op != 'project' or consumers(plan)[inp] != [node]:
+            continue
+        node.params['rel'] = inp.params['rel']
+        node.params['comp'] = fuse(inp.params['comp'], node.params['comp'])
+        node.notes.append('fused with project')
+        plan.remove(inp)
+
+def skip_sorts(plan):
+    # Private aggregation and the sort-based join leave their output
+    # sorted on the first column. Selects, compaction and gathers keep
+    # the order of rows.
+    sorted_on = {}
+    for node in plan:
+        inp = node.params.get('rel')
+        if node.op == 'aggregate_sum' and is_private(node):
+            key_col = node.params['key_col']
+            if sorted_on.get(inp) == key_col:
+                node.params['presorted'] = True
+                node.notes.append('input already sorted')
+            # The output starts with the key columns
+            sorted_on[node] = 0 if isinstance(key_col, int) \
+                else range(len(key_col))
+        elif node.op == 'join' and is_private(node) \
+                and node.params['is_key_unique']:
+            sorted_on[node] = 0
+        elif node.op in ('select', 'gather'):
+            sorted_on[node] = sorted_on.get(inp)
+
+def compacted_later(node, cons, filtered=False):
+    # Whether every path from node leads through a filtering select to an
+    # operator that compacts its input, passing only projects and selects
+    if not cons[node]:
+        return False
+    for consumer in cons[node]:
+        if consumer.op in ('project', 'select'):
+            if not compacted_later(consumer, cons,
+                    filtered or is_filter(consumer)):
+                return False
+        elif not filtered:
+            return False
+    return True
+
+def skip_compactions(plan):
+    # The output of a private operator need not be compacted if it gets
+    # filtered and compacted again before anything else looks at it
+    cons = consumers(plan)
+    for node in plan:
+        if is_private(node) and node.params['compact'] \
+                and compacted_later(node, cons):
+            node.params['compact'] = False
+            node.notes.append('output compacted downstream')
+
+def defer_compactions(plan):
+    # Private operators pass on padded relations, which are only compacted
+    # by the operators that need the exact rows
+    padded = set()
+    for node in plan:
+        if any(inp in padded for inp in node.inputs()):
+            if is_private(node) or node.op in ('project', 'select', 'divide'):
+                padded.add(node)
+            else:
+                node.compacts = True
+                node.notes.append('compacts deferred padding')
+        if is_private(node):
+            if node.params['compact']:
+                node.params['compact'] = False
+                node.notes.append('compaction deferred')
+            padded.add(node)
+
+def optimize(plan, defer_compaction=False):
+    push_down_selects(plan, defer_compaction)
+    fuse_projects(plan)
+    skip_sorts(plan)
+    if defer_compaction:
+        defer_compactions(plan)
+    else:
+        skip_compactions(plan)
+
+def sort_comparisons(n):
+    # Size of the bitonic sorting network on n elements
+    if n < 2:
+        return 0
+    k = int(ceil(log(n, 2)))
+    return n * k * (k + 1) // 4
+
+def estimate(node, rows):
+    # Returns the estimated number of output rows of node, and its
+    # estimated number of comparisons, equality tests, compacted rows and
+    # opened values, given the estimated sizes of its inputs in rows.
+    # Filters are oblivious, so their output is as large as their input.
+    if node.op in ('scatter', 'shared'):
+        return rows[None], 0, 0, 0, 0
+    params, private = node.params, is_private(node)
+    n = rows[params['rel']]
+    compacted = n if private and params['compact'] else 0
+    if node.op == 'join':
+        m = rows[params['other_rel']]
+        if not private:
+            return max(n, m), 0, 0, node.compacts and n + m, 0
+        # Without compaction, the output is padded to its largest size
+        if params['is_key_unique']:
+            out = m if params['compact'] else n + m
+            return out, sort_comparisons(n + m), n + m, \
+                compacted and n + m, 0
+        out = max(n, m) if params['compact'] else n * m
+        return out, 0, n * m, compacted and n * m, 0
+    elif node.op == 'aggregate_sum' and private:
+        # Unpacked composite keys are compared column by column
+        width = 1 if isinstance(params['key_col'], int) \
+            or params['key_widths'] else len(params['key_col'])
+        comparisons = 0 if params['presorted'] else sort_comparisons(n)
+        return n, comparisons * width, \
+            comparisons * (width - 1) + max(n - 1, 0) * width, compacted, 0
+    elif node.op == 'aggregate':
+        extremes = [op for op, _ in params['aggs'] if op in ('min', 'max')]
+        return n, n * len(extremes), 0, node.compacts and n, 0
+    elif node.op == 'divide' and params['method'] == 'bitwise':
+        return n, n * (params['l'] + 1), 0, 0, 0
+    elif node.op == 'topk':
+        # Imported here, as extensions imports this module
+        from extensions import topk_comparisons
+        return min(n, params['k']), topk_comparisons(n, params['k']), 0, \
+            node.compacts and n, 0
+    elif node.op == 'gather':
+        return n, 0, 0, node.compacts and n, n * len(params['cols_to_gather'])
+    return n, 0, 0, node.compacts and n, 0
+
+COSTS = ['comparisons', 'equality tests', 'compacted rows', 'opened values']
+
+def costs(plan, num_rows):
+    # Yields every node with its estimated number of output rows and its
+    # estimated costs by name
+    rows = {None: num_rows}
+    for node in plan:
+        estimated = estimate(node, rows)
+        rows[node] = estimated[0]
+        yield node, estimated[0], zip(COSTS, estimated[1:])
+
+def totals(plan, num_rows):
+    result = dict((name, 0) for name in COSTS)
+    for _, _, node_costs in costs(plan, num_rows):
+        for name, cost in node_costs:
+            result[name] += cost
+    return result
+
+def explain(plan, num_rows):
+    lines = []
+    names = dict((node, idx) for idx, node in enumerate(plan))
+    for node, out, node_costs in costs(plan, num_rows):
+        inputs = ', '.join([str(names[inp]) for inp in node.inputs()])
+        line = '%d: %s(%s) rows~%d' % (names[node], node.op, inputs, out)
+        for name, cost in node_costs:
+            if cost:
+                line += ', %s~%d' % (name, cost)
+        if node.notes:
+            line += ' [%s]' % '; '.join(node.notes)
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,203 @@
+from viff.field import GF, GF256
+from viff.runtime import Share, gather_shares
+import os
+
+# Offline preprocessing for comparisons and equality tests. Both draw
+# random shares through PRSS; random bits even cost an opening each. With
+# PreprocessingMixin, all such draws are served from a pool generated
+# ahead of time, e.g.
+#
+#   rt.record_draws(path)               -> draws of a run, by program counter
+#   generate(rt, load_needed(path))     -> pool, then save(pool, path)
+#
+# and, in the online phase, rt.use_preprocessed(load(path)). Multiplications
+# cannot be preprocessed with passive BGW.
+#
+# PreprocessingMixin overrides methods of PassiveRuntime, so it must come
+# before it in the method resolution order. make_runtime_class puts the
+# runtime class first, hence the mixin goes into the runtime class, e.g.
+#
+#   make_runtime_class(type('R', (PreprocessingMixin, PassiveRuntime), {}),
+#                      [ProbabilisticEqualityMixin, ComparisonToft07Mixin])
+#
+# As in VIFF's own preprocessing, draws are keyed by (kind, modulus,
+# binary) and the program counter of the draw. Callbacks run in the order
+# in which messages arrive, which differs between players, but the
+# program counter of a draw is the same on all of them. A run on other
+# data of the same size makes the same draws, up to the sizes revealed by
+# compaction; draws that are not in the pool are made online, by all
+# players alike. This relies on every draw having a program counter of
+# its own, see scheduler.schedule_forked; a draw whose key was drawn
+# before fails, as players could otherwise combine pooled and online
+# randomness for the same value.
+
+MAGIC = 'RIFFPRE1\n'
+
+def field_of(modulus):
+    return GF256 if modulus == 256 else GF(modulus)
+
+class PreprocessingMixin(object):
+    """Serves PRSS draws from a preprocessed pool and, while recording,
+       notes the draws it cannot serve.
+       """
+
+    preprocessed = None
+    needed_draws = None
+    record_path = None
+    # The keys of all draws while using a pool or recording
+    drawn = None
+
+    def use_preprocessed(self, pool):
+        self.preprocessed = dict(pool)
+        self.drawn = set()
+
+    def record_draws(self, path):
+        # The draws not served from the pool are written to path at
+        # shutdown, see load_needed
+        self.needed_draws = {}
+        self.record_path = path
+        self.drawn = set()
+
+    def shutdown(self):
+        if self.record_path is not None:
+            save_needed(self.needed_draws, self.record_path)
+        return super(PreprocessingMixin, self).shutdown()
+
+    def _take(self, key, count):
+        # Returns the count values pooled for the next draw, or None. Like
+        # every PRSS draw in VIFF, a draw served from the pool increments
+        # the program counter once.
+        if self.drawn is None:
+            return None
+        pc = tuple(self.program_counter[:-1] + [self.program_counter[-1] + 1])
+        draw = key + (pc,)
+        if draw in self.drawn:
+            raise RuntimeError("Draw %s made twice" % format_key(*draw))
+        self.drawn.add(draw)
+        values = (self.preprocessed or {}).pop(draw, None)
+        if values is None or len(values) != count:
+            if self.needed_draws is not None:
+                self.needed_draws[draw] = count
+            return None
+        self.program_counter[-1] += 1
+        return values
+
+    def prss_share_random(self, field, binary=False):
+        key = ('random', field.modulus, binary)
+        values = self._take(key, 1)
+        if values is None:
+            return super(PreprocessingMixin, self).prss_share_random(
+                field, binary)
+        return Share(self, field, field(values[0]))
+
+    def prss_share_random_multi(self, field, quantity, binary=False):
+        key = ('random', field.modulus, binary)
+        values = self._take(key, quantity)
+        if values is None:
+            return super(PreprocessingMixin, self).prss_share_random_multi(
+                field, quantity, binary)
+        return [Share(self, field, field(value)) for value in values]
+
+    def prss_share_bit_double(self, field):
+        key = ('bit_double', field.modulus, True)
+        values = self._take(key, 1)
+        if values is None:
+            return super(PreprocessingMixin, self).prss_share_bit_double(
+                field)
+        bit, small_bit = values[0]
+        return (Share(self, field, field(bit)),
+                Share(self, GF256, GF256(small_bit)))
+
+def generate(rt, needed):
+    """Draws everything in *needed*, as recorded by
+       :meth:`PreprocessingMixin.record_draws`, online and returns a
+       Deferred with the resulting pool, to be saved by every player.
+       """
+    keys = sorted(needed)
+    draws = []
+    for kind, modulus, binary, pc in keys:
+        count = needed[(kind, modulus, binary, pc)]
+        field = field_of(modulus)
+        if kind == 'bit_double':
+            draws.append([value for _ in range(count)
+                          for value in rt.prss_share_bit_double(field)])
+        else:
+            draws.append(rt.prss_share_random_multi(field, count, binary))
+
+    def drawn(values):
+        pool, values = {}, iter(values)
+        for key, shares in zip(keys, draws):
+            vals = [values.next().value for _ in shares]
+            if key[0] == 'bit_double':
+                vals = zip(vals[0::2], vals[1::2])
+            pool[key] = vals
+        return pool
+
+    return rt.schedule_callback(
+        gather_shares([share for shares in draws for share in shares]), drawn)
+
+def format_key(kind, modulus, binary, pc):
+    return '%s %d %d %s' % (kind, modulus, binary,
+                            '.'.join([str(part) for part in pc]))
+
+def parse_key(fields):
+    kind, modulus, binary, pc = fields
+    return (kind, int(modulus), bool(int(binary)),
+            tuple([int(part) for part in pc.split('.')]))
+
+def save_needed(needed, path):
+    # One line per draw, with its key and count
+    out = open(path, 'w')
+    for key, count in sorted(needed.items()):
+        out.write('%s %d\n' % (format_key(*key), count))
+    out.close()
+
+def load_needed(path):
+    needed = {}
+    for line in open(path):
+        fields = line.split()
+        needed[parse_key(fields[:4])] = int(fields[4])
+    return needed
+
+def save(pool, path):
+    # Every draw is stored as a header line and fixed width big-endian
+    # values
+    out = open(path, 'wb')
+    out.write(MAGIC)
+    for key, values in sorted(pool.items()):
+        kind, modulus = key[:2]
+        width = (len('%x' % (modulus - 1)) + 1) // 2
+        out.write('%s %d\n' % (format_key(*key), len(values)))
+        if kind == 'bit_double':
+            values = [value for pair in values for value in pair]
+        out.write(''.join([('%0*x' % (2 * width, value)).decode('hex')
+                           for value in values]))
+    out.close()
+
+def load(path):
+    """Reads a pool written by :func:`save` and removes the file, as
+       preprocessed values must never be used twice.
+       """
+    data = open(path, 'rb').read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a preprocessing file" % path)
+    pool, pos = {}, len(MAGIC)
+    while pos < len(data):
+        end = data.index('\n', pos)
+        fields = data[pos:end].split()
+        key, count = parse_key(fields[:4]), int(fields[4])
+        kind, modulus = key[:2]
+        width = (len('%x' % (modulus - 1)) + 1) // 2
+        arity = 2 if kind == 'bit_double' else 1
+        pos = end + 1
+        if pos + count * arity * width > len(data):
+            raise ValueError("%s is truncated" % path)
+        values = [int(data[start:start + width].encode('hex'), 16)
+                  for start in range(pos, pos + count * arity * width, width)]
+        pos += count * arity * width
+        if arity == 2:
+            values = zip(values[0::2], values[1::2])
+        pool[key] = values
+    # Only now that it is parsed, as its values must never be used twice
+    os.remove(path)
+    return pool
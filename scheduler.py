@@ -0,0 +1,129 @@
+from viff.runtime import Share, gather_shares
+from twisted.internet.defer import Deferred, DeferredList
+import resource
+
+# Flow control for Rel operators. Work is submitted in batches to a
+# stream, and a batch only starts once the batch submitted to the same
+# stream window batches before it has completed, so at most window batches
+# of Shares per stream are in flight at a time. Every operator that
+# submits batches does so to a stream of its own.
+#
+# The gate of every batch is set up when the batch is submitted, batches
+# of a stream start in the order they were submitted, and every batch runs
+# under a program counter of its own. As the batches of a stream are
+# submitted in the same order on all players, all players issue the same
+# operations under the same program counters, whatever the order in which
+# their batches complete. Operators run side by side submit to their
+# streams in an order that differs between players, so a single order
+# across streams could make players wait for each other's batches forever.
+
+def schedule_forked(rt, deferred, func, *args, **kwargs):
+    """Like ``rt.schedule_callback``, but the callback runs under a
+       program counter that no other callback scheduled here gets.
+
+       A callback runs in a fork of the program counter at scheduling time.
+       Callbacks scheduled side by side, such as one per chunk or batch,
+       would otherwise issue their operations under the same counters,
+       drawing the same PRSS randomness and getting each other's messages,
+       which arrive in a different order on every player.
+       """
+    rt.program_counter[-1] += 1
+    result = rt.schedule_callback(deferred, func, *args, **kwargs)
+    rt.program_counter[-1] += 1
+    return result
+
+def peak_rss():
+    # Peak resident set size of this process in KB (on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Scheduler:
+
+    def __init__(self, rt, window):
+        self.rt = rt
+        self.window = window
+        self.queued = 0
+        self.running = 0
+        self.stats = {'batches': 0, 'peak_queued': 0, 'peak_running': 0,
+                      'peak_rss_kb': peak_rss()}
+
+    def stream(self):
+        """Returns a new :class:`Stream` of this scheduler."""
+        return Stream(self)
+
+    def map(self, f, batches):
+        """Submits ``f(batch)`` for every batch to a new stream and returns
+           a Deferred with the concatenated results.
+           """
+        return self.stream().map(f, batches)
+
+class Stream:
+    """Batches of one operator, see :meth:`Scheduler.stream`."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.rt = scheduler.rt
+        self.started = []
+        self.done = []
+
+    def _wait(self, result):
+        # Fires once all Shares in result, a list of Shares or rows, are
+        # known
+        if isinstance(result, Deferred):
+            return result
+        shares = []
+        for row in result:
+            for val in (row if isinstance(row, (list, tuple)) else [row]):
+                if isinstance(val, Share):
+                    shares.append(val)
+        return gather_shares(shares)
+
+    def submit(self, f, *args):
+        """Runs ``f(*args)`` once its turn comes and returns a Deferred
+           with its result, a list of Shares or rows of Shares.
+           """
+        scheduler, stats = self.scheduler, self.scheduler.stats
+        idx = len(self.done)
+        gates = []
+        if idx > 0:
+            gates.append(self.started[idx - 1])
+        if idx >= scheduler.window:
+            gates.append(self.done[idx - scheduler.window])
+        started, done, result = Deferred(), Deferred(), Deferred()
+        self.started.append(started)
+        self.done.append(done)
+        scheduler.queued += 1
+        stats['batches'] += 1
+        stats['peak_queued'] = max(stats['peak_queued'], scheduler.queued)
+
+        def finished(_, out):
+            scheduler.running -= 1
+            stats['peak_rss_kb'] = max(stats['peak_rss_kb'], peak_rss())
+            done.callback(None)
+            result.callback(out)
+
+        def start(_):
+            scheduler.queued -= 1
+            scheduler.running += 1
+            stats['peak_running'] = max(stats['peak_running'],
+                                        scheduler.running)
+            out = f(*args)
+            # Only now may the next batch start, as it may build on this one
+            started.callback(None)
+            if isinstance(out, Deferred):
+                self.rt.schedule_callback(out, lambda out: finished(None, out))
+            else:
+                self.rt.schedule_callback(self._wait(out), finished, out)
+
+        schedule_forked(self.rt, DeferredList(gates), start)
+        return result
+
+    def map(self, f, batches):
+        """Submits ``f(batch)`` for every batch and returns a Deferred with
+           the concatenated results.
+           """
+        results = [self.submit(f, batch) for batch in batches]
+
+        def concat(results):
+            return [row for _, rows in results for row in rows]
+
+        return self.rt.schedule_callback(DeferredList(results), concat)
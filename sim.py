@@ -0,0 +1,337 @@
+from viff.runtime import Share, gather_shares
+from viff.field import GF256
+from viff import shamir
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from collections import deque
+from optparse import Values
+import random
+
+# In-process simulation of a run with n players, e.g.
+#
+#   costs = SimNetwork(3).run(protocol, Zp, num_tups)
+#
+# calls protocol(rt, Zp, num_tups) for the runtime rt of every player, as
+# create_runtime would, and runs all of them to completion without any
+# sockets. Shares are Shamir shares as usual, so Rel's own message paths
+# (chunked scatter and gather) work unchanged, but every interactive
+# operation (multiplication, comparison, equality test, opening, input and
+# random draw) is computed by the network on the recombined values once
+# all players have asked for it, and counted instead of being run.
+#
+# With reorder, queued callbacks and messages are delivered in random
+# order, as they may arrive in any order over the network. An interactive
+# operation or expected message whose program counter a player has used
+# before fails the run: in VIFF, it would reuse PRSS randomness or get the
+# wrong message.
+#
+# The costs use the names of Rel.estimate() where they overlap. Rounds are
+# the depth of the interactive operations, counting each as one round,
+# so a comparison is as deep as a multiplication here.
+
+COSTS = ['multiplications', 'comparisons', 'equality tests',
+         'opened values', 'inputs', 'random draws', 'messages',
+         'bytes sent', 'rounds']
+
+class SimProtocol:
+    # Stands in for the connection of one player to another
+
+    def __init__(self, network, sender, receiver):
+        self.network = network
+        self.sender = sender
+        self.receiver = receiver
+
+    def sendData(self, program_counter, data_type, data):
+        self.network.costs['messages'] += 1
+        self.network.costs['bytes sent'] += len(str(data))
+        self.network.deliver((self.receiver, self.sender,
+                              tuple(program_counter), data_type), data)
+
+class SimRuntime:
+    """Implements the part of the VIFF runtime that Rel uses for one
+       player of a :class:`SimNetwork`.
+       """
+
+    def __init__(self, network, player, num_players, threshold, options):
+        self.network = network
+        self.id = player
+        self.num_players = num_players
+        self.threshold = threshold
+        self.options = options
+        self.players = dict((peer, None)
+                            for peer in range(1, num_players + 1))
+        self.protocols = dict((peer, SimProtocol(network, player, peer))
+                              for peer in self.players if peer != player)
+        self.program_counter = [0]
+        self.finished = False
+        self.used_pcs = set()
+
+    def _next_pc(self):
+        self.program_counter[-1] += 1
+        return self._claim(tuple(self.program_counter))
+
+    def _claim(self, key):
+        if key in self.used_pcs:
+            raise RuntimeError("Player %d reused program counter %s"
+                               % (self.id, key))
+        self.used_pcs.add(key)
+        return key
+
+    def schedule_callback(self, deferred, func, *args, **kwargs):
+        # As in VIFF, the callback runs in a fork of the program counter
+        # at scheduling time
+        saved_pc = self.program_counter[:]
+
+        def callback_wrapper(*args, **kwargs):
+            current_pc = self.program_counter[:]
+            self.program_counter[:] = saved_pc + [0]
+            try:
+                return func(*args, **kwargs)
+            except:
+                # Twisted would keep the failure in the Deferred, where
+                # no one may ever look
+                self.network.failures.append(Failure())
+                raise
+            finally:
+                self.program_counter[:] = current_pc
+
+        return deferred.addCallback(callback_wrapper, *args, **kwargs)
+
+    def handle_deferred_data(self, deferred, data):
+        self.network.queue.append((deferred, data))
+
+    def _expect_data(self, peer_id, data_type, deferred):
+        self._claim((peer_id, data_type, tuple(self.program_counter)))
+        self.network.deliver((self.id, peer_id, tuple(self.program_counter),
+                              data_type), deferred)
+
+    def activate_reactor(self):
+        pass
+
+    def shutdown(self):
+        self.finished = True
+
+    def _lift(self, value, field):
+        if isinstance(value, Share):
+            return value
+        return Share(self, field, field(value))
+
+    def _local(self, share_a, share_b, f):
+        # Linear operations on shares need no interaction. The result is
+        # resolved through the queue rather than right away, so that long
+        # chains of them, such as a sum, do not nest callbacks.
+        field = getattr(share_a, 'field', None) or share_b.field
+        share_a, share_b = self._lift(share_a, field), \
+            self._lift(share_b, field)
+        result = Share(self, field)
+        result.round = max(getattr(share_a, 'round', 0),
+                           getattr(share_b, 'round', 0))
+        gather_shares([share_a, share_b]).addCallback(
+            lambda (a, b): self.network.queue.append((result, f(a, b))))
+        return result
+
+    def _ideal(self, kind, operands, fields, compute, cost, count=1):
+        # Returns a Share per field in fields, computed by the network from
+        # the recombined operands as soon as all players have called this.
+        # compute returns a value per Share, shared with the threshold of
+        # the network, or a pair of the value and its threshold, which is
+        # None for values that are opened.
+        pc = self._next_pc()
+        results = [Share(self, field) for field in fields]
+        depth = max([getattr(operand, 'round', 0)
+                     for operand in operands] + [0]) + 1
+        for result in results:
+            result.round = depth
+
+        def submit(received):
+            received = iter(received)
+            values = [received.next() if isinstance(operand, Deferred)
+                      else operand for operand in operands]
+            self.network.submit(self, (kind, pc), values, results, compute,
+                                cost, count, depth)
+
+        gather_shares([operand for operand in operands
+                       if isinstance(operand, Deferred)]).addCallback(submit)
+        return results
+
+    def add(self, share_a, share_b):
+        return self._local(share_a, share_b, lambda a, b: a + b)
+
+    def sub(self, share_a, share_b):
+        return self._local(share_a, share_b, lambda a, b: a - b)
+
+    def mul(self, share_a, share_b):
+        if not isinstance(share_a, Share) or not isinstance(share_b, Share):
+            return self._local(share_a, share_b, lambda a, b: a * b)
+        return self._ideal('mul', [share_a, share_b], [share_a.field],
+                           lambda a, b: [a * b], 'multiplications')[0]
+
+    def xor(self, share_a, share_b):
+        field = getattr(share_a, 'field', None) or share_b.field
+        if field is GF256:
+            return self.add(share_a, share_b)
+        share_a, share_b = self._lift(share_a, field), \
+            self._lift(share_b, field)
+        return share_a + share_b - 2 * share_a * share_b
+
+    def greater_than_equal(self, share_a, share_b):
+        field = getattr(share_a, 'field', None) or share_b.field
+        share_a, share_b = self._lift(share_a, field), \
+            self._lift(share_b, field)
+        return self._ideal('ge', [share_a, share_b], [field],
+            lambda a, b: [field(int(a.value >= b.value))], 'comparisons')[0]
+
+    def equal(self, share_a, share_b):
+        field = getattr(share_a, 'field', None) or share_b.field
+        share_a, share_b = self._lift(share_a, field), \
+            self._lift(share_b, field)
+        return self._ideal('eq', [share_a, share_b], [field],
+            lambda a, b: [field(int(a == b))], 'equality tests')[0]
+
+    def open(self, share, receivers=None, threshold=None):
+        receivers = receivers or sorted(self.players)
+        result = self._ideal('open', [share], [share.field],
+                             lambda a: [(a, None)], 'opened values')[0]
+        if self.id in receivers:
+            return result
+
+    def output(self, share, receivers=None, threshold=None):
+        return self.open(share, receivers, threshold)
+
+    def shamir_share(self, inputters, field, number=None, threshold=None):
+        # Like VIFF, returns a single Share if there is one inputter
+        if threshold is None:
+            threshold = self.threshold
+        numbers = [field(number) if inputter == self.id else None
+                   for inputter in inputters]
+        results = self._ideal('share', numbers, [field] * len(inputters),
+            lambda *numbers: [(number, threshold) for number in numbers],
+            'inputs', len(inputters))
+        return results[0] if len(results) == 1 else results
+
+    input = shamir_share
+
+    def prss_share_random(self, field, binary=False):
+        return self.prss_share_random_multi(field, 1, binary)[0]
+
+    def prss_share_random_multi(self, field, quantity, binary=False):
+        rand = self.network.random
+        return self._ideal('random', [], [field] * quantity, lambda:
+            [field(rand.randint(0, 1) if binary
+                   else rand.randrange(field.modulus))
+             for _ in range(quantity)], 'random draws', quantity)
+
+    def prss_share_bit_double(self, field):
+
+        def draw():
+            bit = self.network.random.randint(0, 1)
+            return [field(bit), GF256(bit)]
+
+        return tuple(self._ideal('bit', [], [field, GF256], draw,
+                                 'random draws'))
+
+class SimNetwork:
+    """Connects the runtimes of *n* simulated players, of which up to
+       *threshold* may be corrupt.
+       """
+
+    def __init__(self, n=3, threshold=1, bit_length=32,
+                 security_parameter=30, seed=None, reorder=False):
+        options = Values({'bit_length': bit_length,
+                          'security_parameter': security_parameter})
+        self.runtimes = [SimRuntime(self, player, n, threshold, options)
+                         for player in range(1, n + 1)]
+        self.threshold = threshold
+        self.random = random.Random(seed)
+        self.reorder = reorder
+        self.queue = deque()
+        self.pending = {}
+        self.mailboxes = {}
+        self.failures = []
+        self.costs = dict((name, 0) for name in COSTS)
+
+    def deliver(self, key, item):
+        # Matches data sent to a player with the Deferred it expects it
+        # in, whichever of both comes first. As in VIFF, several of either
+        # with the same program counter are matched in order.
+        waiting = self.mailboxes.setdefault(key, deque())
+        if not waiting or isinstance(waiting[0], Deferred) \
+                == isinstance(item, Deferred):
+            waiting.append(item)
+            return
+        other = waiting.popleft()
+        if not waiting:
+            del self.mailboxes[key]
+        if isinstance(item, Deferred):
+            self.queue.append((item, other))
+        else:
+            self.queue.append((other, item))
+
+    def secret(self, entries, idx):
+        # Recombines the idx-th operand from the shares of all players,
+        # or returns the value of the one player that has it
+        values = [(player, values[idx])
+                  for player, (values, _) in sorted(entries.items())]
+        known = [value for _, value in values if value is not None]
+        if len(known) < len(values):
+            return known[0] if known else None
+        field = known[0].field
+        return shamir.recombine([(field(player), value) for player, value
+                                 in values[:self.threshold + 1]])
+
+    def submit(self, rt, key, values, results, compute, cost, count, depth):
+        # Calls with the same program counter are matched in order
+        calls = self.pending.setdefault(key, [])
+        for entries in calls:
+            if rt.id not in entries:
+                break
+        else:
+            entries = {}
+            calls.append(entries)
+        entries[rt.id] = (values, results)
+        if len(entries) < len(self.runtimes):
+            return
+        calls.remove(entries)
+        if not calls:
+            del self.pending[key]
+        operands = [self.secret(entries, idx) for idx in range(len(values))]
+        self.costs[cost] += count
+        self.costs['rounds'] = max(self.costs['rounds'], depth)
+        n = len(self.runtimes)
+        for idx, output in enumerate(compute(*operands)):
+            secret, threshold = output if isinstance(output, tuple) \
+                else (output, self.threshold)
+            if threshold is None:
+                shares = [secret] * n
+            else:
+                shares = [share for _, share
+                          in shamir.share(secret, threshold, n)]
+            for player, (_, player_results) in entries.items():
+                self.queue.append((player_results[idx], shares[player - 1]))
+
+    def run(self, protocol, *args, **kwargs):
+        """Runs *protocol* for every player and returns the costs of the
+           run. Raises RuntimeError if any callback failed, with the
+           traceback of the first failure, or if the run stalled.
+           """
+        for rt in self.runtimes:
+            protocol(rt, *args, **kwargs)
+            self._drain()
+        self._drain()
+        if self.failures:
+            raise RuntimeError("%d callbacks failed, the first with:\n%s"
+                               % (len(self.failures),
+                                  self.failures[0].getTraceback()))
+        if not all(rt.finished for rt in self.runtimes):
+            raise RuntimeError("Simulation stalled with %d operations and "
+                               "%d messages pending"
+                               % (len(self.pending), len(self.mailboxes)))
+        return self.costs
+
+    def _drain(self):
+        while self.queue:
+            if self.reorder:
+                idx = self.random.randrange(len(self.queue))
+                self.queue[idx], self.queue[0] = self.queue[0], self.queue[idx]
+            deferred, data = self.queue.popleft()
+            deferred.callback(data)
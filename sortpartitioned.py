@@ -0,0 +1,96 @@
+from optparse import OptionParser
+import viff.reactor
+viff.reactor.install()
+from twisted.internet import reactor
+
+from viff.field import GF
+from viff.runtime import make_runtime_class, create_runtime, Runtime
+from viff.comparison import ComparisonToft07Mixin
+from viff.equality import ProbabilisticEqualityMixin
+from viff.config import load_config
+from viff.util import find_prime
+
+from extensions import Rel, sort
+from partition import worker_configs, shard, spawn_workers, wait, save_rel, load_rel, \
+    merge_sorted
+import random
+import sys
+import time
+
+# Private sort over k workers per player, e.g.
+#
+#   python sortpartitioned.py player-1.ini 10000 4 --no-ssl
+#
+# Every worker projects and sorts its own shard of the rows, and the
+# coordinator merges the sorted shards with merge_sorted. Comparing the
+# times printed for different k shows how the sort scales with the
+# number of workers.
+
+def inputgen(pid, num_tups):
+    # Seeded, so that all workers of a player see the same input
+    rand = random.Random(pid)
+    return [(rand.randint(0, 2**14), 1) for _ in range(num_tups)] if pid == 1 else []
+
+def output(rel, started):
+    print "Result: %d rows in %.3fs" % (len(rel), time.time() - started)
+
+def result_path(config, worker):
+    return '%s.worker%d.out' % (config, worker)
+
+def save_sorted(rel, path, started):
+
+    def saved(_):
+        print "Sorted %d rows in %.3fs" % (len(rel), time.time() - started)
+
+    d = save_rel(sort(rel, lambda row: row[0]), path)
+    d.addCallback(saved)
+    return d
+
+def worker(rt, Zp, num_tups, k, w, path):
+    ext = Rel(rt)
+    rows = shard(inputgen(rt.id, num_tups), k)[w]
+    selected_input = ext.scatter(rows, Zp, [1, 1])
+    scaled = ext.project(selected_input, lambda e1, e2: [e1, e2 * 100])
+    ext.outputwith(scaled, lambda rel: save_sorted(rel, path, time.time()))
+    ext.finish()
+
+def coordinator(rt, Zp, paths, started):
+    ext = Rel(rt)
+    parts = [load_rel(rt, Zp, path) for path in paths]
+    merged = ext.shared(merge_sorted(parts, lambda row: row[0]))
+    gathered = ext.gather(merged, [0, 1], rt.players.keys())
+    ext.outputwith(gathered, lambda rel: output(rel, started))
+    ext.finish()
+
+def report_error(err):
+    sys.stderr.write(str(err))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--worker", type="int", default=None,
+        help="run as worker WORKER (set by the coordinator)")
+    Runtime.add_options(parser)
+    options, args = parser.parse_args()
+    num_tups, k = int(args[1]), int(args[2])
+    Zp = GF(find_prime(2**65, blum=True))
+
+    if options.worker is None:
+        started = time.time()
+        configs = worker_configs(args[0], k)
+        wait(spawn_workers(configs))
+        paths = [result_path(config, w) for w, config in enumerate(configs)]
+        start = lambda rt: coordinator(rt, Zp, paths, started)
+    else:
+        path = result_path(args[0], options.worker)
+        start = lambda rt: worker(rt, Zp, num_tups, k, options.worker, path)
+    pid, players = load_config(args[0])
+
+    runtime_class = make_runtime_class(
+        mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
+    )
+    pre_runtime = create_runtime(pid, players, 1, options,
+        runtime_class=runtime_class)
+    pre_runtime.addCallback(start)
+    pre_runtime.addErrback(report_error)
+
+    reactor.run()
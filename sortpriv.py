@@ -0,0 +1,66 @@
+from optparse import OptionParser
+import viff.reactor
+viff.reactor.install()
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+
+from viff.field import GF
+from viff.runtime import make_runtime_class, create_runtime, gather_shares, Runtime
+from viff.comparison import ComparisonToft07Mixin
+from viff.equality import ProbabilisticEqualityMixin
+from viff.config import load_config
+from viff.util import find_prime
+
+from extensions import Rel, sort
+import random
+import sys
+import time
+
+# Times extensions.sort on num_tups private keys, e.g.
+#
+#   python sortpriv.py player-1.ini 1000 shuffle
+#
+# with method either bitonic (the default) or shuffle.
+
+def inputgen(pid, num_tups):
+    return [(random.randint(0, 2**14), 1) for _ in range(num_tups)] if pid == 1 else []
+
+def timed_sort(rel, method):
+
+    def sorted_received(_, start):
+        print "Sorted %d rows with %s in %.3fs" % \
+            (len(rel), method, time.time() - start)
+
+    start = time.time()
+    sorted_rel = sort(rel, lambda x: x[0], method=method)
+    d = gather_shares([val for row in sorted_rel for val in row])
+    d.addCallback(sorted_received, start)
+    return d
+
+def protocol(rt, Zp, num_tups, method):
+    ext = Rel(rt)
+    selected_input = ext.scatter(inputgen(rt.id, num_tups), Zp, [1, 1])
+    ext.outputwith(selected_input, lambda rel: timed_sort(rel, method))
+    ext.finish()
+
+def report_error(err):
+    sys.stderr.write(str(err))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    Runtime.add_options(parser)
+    options, args = parser.parse_args()
+    pid, players = load_config(args[0])
+    num_tups = int(args[1])
+    method = args[2] if len(args) > 2 else 'bitonic'
+    Zp = GF(find_prime(2**65, blum=True))
+
+    runtime_class = make_runtime_class(
+        mixins=[ProbabilisticEqualityMixin, ComparisonToft07Mixin]
+    )
+    pre_runtime = create_runtime(pid, players, 1, options,
+        runtime_class=runtime_class)
+    pre_runtime.addCallback(protocol, Zp, num_tups, method)
+    pre_runtime.addErrback(report_error)
+
+    reactor.run()
@@ -0,0 +1,124 @@
+from viff.field import GF
+from viff.util import find_prime
+
+from extensions import Rel
+from sim import SimNetwork
+import unittest
+
+# Pipelines run in the simulator with messages delivered in random order,
+# which also fails a run if a player reuses a program counter, see sim.py
+
+Zp = GF(find_prime(2**65, blum=True))
+RUNS = 10
+
+def run(protocol, seed, **kwargs):
+    out = {}
+    SimNetwork(3, seed=seed, reorder=True).run(protocol, out, **kwargs)
+    return out
+
+def rows(rel):
+    return sorted([tuple([int(val) for val in row]) for row in rel])
+
+class ChunkTest(unittest.TestCase):
+
+    def test_gather_chunks_of_two_inputters(self):
+
+        def protocol(rt, out):
+            ext = Rel(rt)
+            rel = ext.scatter([[rt.id * 100 + i, i] for i in range(6)]
+                              if rt.id in (1, 2) else [],
+                              Zp, [1, 1], chunk_size=3)
+            ext.outputwith(ext.gather(rel, [0, 1], [1, 2, 3]),
+                           lambda rel: out.setdefault(rt.id, []).extend(rel))
+            ext.finish()
+
+        expected = [(player * 100 + i, i) for player in (1, 2)
+                    for i in range(6)]
+        for seed in range(RUNS):
+            out = run(protocol, seed)
+            for player in (1, 2, 3):
+                self.assertEqual(rows(out[player]), expected)
+
+    def test_select_and_divide_chunks(self):
+
+        def protocol(rt, out):
+            ext = Rel(rt)
+            rel = ext.scatter([[i, i + 1] for i in range(6)]
+                              if rt.id in (1, 2) else [],
+                              Zp, [1, 1], chunk_size=2)
+            selected = ext.select(rel, lambda val: val <= 2, [0])
+            divided = ext.divide(rel, 1, 0)
+            for name, result, cols in [('select', selected, [0, 1]),
+                                       ('divide', divided, [0, 1])]:
+                ext.outputwith(ext.gather(result, cols, [1, 2, 3]),
+                    lambda rel, name=name:
+                        out.setdefault(name, []).extend(rel or []))
+            ext.finish()
+
+        # Divided by 0, divide returns 2**13 - 1
+        expected = {
+            'select': [(i, i + 1) for i in range(3) for _ in range(2)],
+            'divide': sorted([(0, 2**13 - 1)] * 2
+                             + [(i, (i + 1) // i) for i in range(1, 6)] * 2)}
+        for seed in range(RUNS):
+            out = run(protocol, seed)
+            # Every player adds its output
+            for name, rel in expected.items():
+                self.assertEqual(rows(out[name]),
+                                 sorted(rel * 3))
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_aggregate_in_window(self):
+
+        def protocol(rt, out):
+            ext = Rel(rt, window=2)
+            rel = ext.scatter([[i % 4, 1] for i in range(12)]
+                              if rt.id == 1 else [], Zp, [1, 1])
+            aggregated = ext.aggregate_sum(rel, 0, 1, True)
+            ext.outputwith(ext.gather(aggregated, [0, 1], [1]),
+                           lambda rel: out.setdefault(rt.id, rel))
+            ext.finish()
+
+        for seed in range(RUNS):
+            out = run(protocol, seed)
+            self.assertEqual(rows(out[1]), [(key, 3) for key in range(4)])
+
+    def test_chunked_scatters_in_window(self):
+        # Both scatters submit their chunks as their sizes arrive, which
+        # is in a different order on every player
+
+        def protocol(rt, out):
+            ext = Rel(rt, window=1)
+            for idx in range(2):
+                rel = ext.scatter([[rt.id, i] for i in range(6)]
+                                  if rt.id in (1, 2) else [],
+                                  Zp, [1, 1], chunk_size=2)
+                ext.outputwith(ext.gather(rel, [0, 1], [1]),
+                    lambda rel, idx=idx:
+                        out.setdefault(idx, []).extend(rel or []))
+            ext.finish()
+
+        expected = [(player, i) for player in (1, 2) for i in range(6)]
+        for seed in range(RUNS):
+            out = run(protocol, seed)
+            self.assertEqual(rows(out[0]), expected)
+            self.assertEqual(rows(out[1]), expected)
+
+class PlanTest(unittest.TestCase):
+
+    def test_topk_checks_k_when_recorded(self):
+
+        def protocol(rt, out):
+            ext = Rel(rt)
+            rel = ext.scatter([[i, i] for i in range(4)]
+                              if rt.id == 1 else [], Zp, [1, 1])
+            self.assertRaises(ValueError, ext.topk, rel, 0, 0)
+            self.assertEqual(len(ext.plan), 1)
+            out[rt.id] = True
+            ext.finish()
+
+        self.assertEqual(run(protocol, 0), {1: True, 2: True, 3: True})
+
+if __name__ == '__main__':
+    unittest.main()